@@ -1,8 +1,31 @@
 from ratelimitbackend import admin
 
+from django.contrib.admin.views.main import ChangeList
+
 from django_push.subscriber.models import Subscription
 
-from .models import Category, UniqueFeed, Feed, Entry, Favicon
+from .models import Category, UniqueFeed, Feed, UniqueEntry, Entry, Favicon
+
+
+class ProjectedChangeList(ChangeList):
+    def get_query_set(self, request):
+        fields = self.model_admin.list_only
+        related = set([name.split('__')[0] for name in fields if '__' in name])
+        # Related objects are only loaded with the listed fields
+        self.root_query_set = self.root_query_set.select_related(
+            *related).only(*fields)
+        return super(ProjectedChangeList, self).get_query_set(request)
+
+
+class ProjectedAdmin(admin.ModelAdmin):
+    """
+    Changelists only load the ``list_only`` fields, for models with large
+    text columns.
+    """
+    list_only = ()
+
+    def get_changelist(self, request, **kwargs):
+        return ProjectedChangeList
 
 
 class FeedInline(admin.TabularInline):
@@ -34,10 +57,18 @@ class FeedAdmin(admin.ModelAdmin):
     raw_id_fields = ('category',)
 
 
-class EntryAdmin(admin.ModelAdmin):
+class UniqueEntryAdmin(ProjectedAdmin):
     list_display = ('title', 'date')
+    list_only = ('title', 'date')
     search_fields = ('title', 'link', 'permalink')
-    raw_id_fields = ('feed', 'user')
+    raw_id_fields = ('feed',)
+
+
+class EntryAdmin(ProjectedAdmin):
+    list_display = ('content', 'date')
+    list_only = ('date', 'content', 'content__title')
+    search_fields = ('content__title', 'content__link', 'content__permalink')
+    raw_id_fields = ('feed', 'content', 'user')
 
 
 class SubscriptionAdmin(admin.ModelAdmin):
@@ -54,6 +85,7 @@ class FaviconAdmin(admin.ModelAdmin):
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(UniqueFeed, UniqueFeedAdmin)
 admin.site.register(Feed, FeedAdmin)
+admin.site.register(UniqueEntry, UniqueEntryAdmin)
 admin.site.register(Entry, EntryAdmin)
 admin.site.register(Favicon, FaviconAdmin)
 admin.site.register(Subscription, SubscriptionAdmin)
@@ -0,0 +1,211 @@
+"""
+JSON API for clients keeping a copy of the entries of a user.
+
+``sync`` lists the entries added or whose read state changed since a sync
+token (see ``sync.py``), the ids of the entries deleted since then in
+``deleted``, the feeds and categories marked as read and the current unread
+counts. Without a token, or with a token that is too old, it lists all the
+entries and ``reset`` tells the client to drop its copy.
+Pages are linked with ``next``: clients follow it until it's null and keep
+the ``token`` of the last page. The watermarks of a page apply before the
+read state of its entries.
+
+Entry bodies aren't part of the lists, ``entries`` fetches them by id.
+Responses are streamed and entries are loaded in chunks, so that large syncs
+don't build whole pages in memory.
+"""
+import json
+
+from functools import wraps
+
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import urlencode
+from django.views.decorators.http import require_GET
+
+from . import counters, sync
+from .models import Entry
+
+PAGE_SIZE = 500
+CHUNK_SIZE = 100
+# Bodies fetched by request
+MAX_IDS = 100
+
+SYNC_FIELDS = (
+    'date', 'read', 'feed', 'category', 'content',
+    'feed__read_through', 'feed__category', 'feed__category__read_through',
+    'content__sanitized_title', 'content__link', 'content__permalink',
+)
+BODY_FIELDS = (
+    'content', 'content__sanitized_title', 'content__sanitized_content',
+    'content__has_media', 'content__link', 'content__permalink',
+)
+
+
+def json_response(data, status=200):
+    return HttpResponse(json.dumps(data), status=status,
+                        content_type='application/json')
+
+
+def api_login_required(view):
+    """Errors instead of the login page"""
+    def check_login(request, *args, **kwargs):
+        if not request.user.is_authenticated():
+            return json_response({'error': 'Authentication required'},
+                                 status=403)
+        return view(request, *args, **kwargs)
+    return wraps(view)(check_login)
+
+
+def get_int(request, name):
+    """An integer parameter, None if it's missing. Raises ValueError."""
+    value = request.GET.get(name)
+    if value is None:
+        return None
+    return int(value)
+
+
+def stream_json(items, fields):
+    """
+    Streams a JSON object: ``entries`` is filled as ``items`` is consumed,
+    then the other ``fields`` (name, value) are written. ``fields`` is read
+    once ``items`` is exhausted.
+    """
+    yield '{"entries": ['
+    for index, item in enumerate(items):
+        yield (',' if index else '') + json.dumps(item)
+    yield ']'
+    for name, value in fields:
+        yield ', %s: %s' % (json.dumps(name), json.dumps(value))
+    yield '}'
+
+
+def iter_entries(entries, ids, serialize, missing):
+    """
+    Loads the ``entries`` with the given ids in chunks, in the order of
+    ``ids``. The ids that aren't found are added to ``missing``.
+    """
+    for start in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[start:start + CHUNK_SIZE]
+        found = entries.in_bulk(chunk)
+        for pk in chunk:
+            if pk in found:
+                yield serialize(found[pk])
+            else:
+                missing.append(pk)
+
+
+def serialize_entry(entry):
+    return {
+        'id': entry.pk,
+        'feed': entry.feed_id,
+        'category': entry.category_id,
+        'date': entry.date.isoformat(),
+        'read': entry.is_read,
+        'title': entry.content.sanitized_title,
+        'link': entry.content.get_link(),
+    }
+
+
+def serialize_body(entry):
+    return {
+        'id': entry.pk,
+        'title': entry.content.sanitized_title,
+        'link': entry.content.get_link(),
+        'content': entry.content.sanitized_content,
+        'has_media': entry.content.has_media,
+    }
+
+
+@require_GET
+@api_login_required
+def sync_entries(request):
+    """The entries that changed since ``since``, or all of them"""
+    user = request.user
+    try:
+        since = get_int(request, 'since')
+        token = get_int(request, 'token')
+        after = get_int(request, 'after')
+    except ValueError:
+        return json_response({'error': 'Invalid token'}, status=400)
+
+    changes = None
+    if since is not None:
+        changes = sync.get_changes(user.pk, since, PAGE_SIZE + 1)
+
+    watermarks = []
+    if changes is None:
+        # Everything, by id. The token is taken before the first page: what
+        # changes while the pages are fetched is listed by the next sync.
+        reset = after is None
+        if token is None:
+            token = sync.get_token(user.pk)
+        ids = list(user.entries.filter(pk__gt=after or 0).order_by(
+            'pk').values_list('pk', flat=True)[:PAGE_SIZE + 1])
+        next_page = None
+        if len(ids) > PAGE_SIZE:
+            ids = ids[:PAGE_SIZE]
+            next_page = {'token': token, 'after': ids[-1]}
+    else:
+        reset = False
+        token, changes = changes
+        next_page = None
+        if len(changes) > PAGE_SIZE:
+            changes = changes[:PAGE_SIZE]
+            token = changes[-1][0]
+            next_page = {'since': token}
+        ids = []
+        for sequence, kind, pk, read_through in changes:
+            if kind == 'entry':
+                ids.append(pk)
+            else:
+                watermarks.append({kind: pk, 'read_through': read_through})
+
+    counts = counters.get_counts(user.pk)
+    if next_page is not None:
+        next_page = '%s?%s' % (reverse('feeds:api_sync'),
+                               urlencode(sorted(next_page.items())))
+
+    entries = Entry.objects.filter(user=user).select_related(
+        'feed', 'feed__category', 'content',
+    ).only(*SYNC_FIELDS)
+    deleted = []
+    fields = [
+        ('deleted', deleted),
+        ('read_through', watermarks),
+        ('unread', {
+            'total': counts.total,
+            'categories': counts.categories,
+            'feeds': counts.feeds,
+        }),
+        ('reset', reset),
+        ('token', str(token)),
+        ('next', next_page),
+    ]
+    return StreamingHttpResponse(
+        stream_json(iter_entries(entries, ids, serialize_entry, deleted),
+                    fields),
+        content_type='application/json')
+
+
+@require_GET
+@api_login_required
+def entry_bodies(request):
+    """The bodies of the entries listed in ``ids``, comma-separated"""
+    try:
+        ids = [int(pk) for pk in request.GET.get('ids', '').split(',') if pk]
+    except ValueError:
+        return json_response({'error': 'Invalid ids'}, status=400)
+    if len(ids) > MAX_IDS:
+        return json_response({
+            'error': 'At most %s entries can be fetched at once' % MAX_IDS,
+        }, status=400)
+
+    entries = Entry.objects.filter(user=request.user).select_related(
+        'content',
+    ).only(*BODY_FIELDS)
+    missing = []
+    return StreamingHttpResponse(
+        stream_json(iter_entries(entries, ids, serialize_body, missing),
+                    [('missing', missing)]),
+        content_type='application/json')
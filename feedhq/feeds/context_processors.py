@@ -0,0 +1,23 @@
+from django.utils.functional import SimpleLazyObject
+
+from . import counters, generations
+
+
+def unread_counts(request):
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated():
+        return {}
+    return {'unread_counts': SimpleLazyObject(
+        lambda: counters.get_request_counts(request))}
+
+
+def fragments(request):
+    """The generation and timeout of the cached template fragments"""
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated():
+        return {}
+    return {
+        'generation': SimpleLazyObject(
+            lambda: generations.get_request_generation(request)),
+        'fragment_timeout': generations.FRAGMENT_TIMEOUT,
+    }
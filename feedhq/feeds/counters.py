@@ -0,0 +1,93 @@
+"""
+Unread counts, kept in Redis.
+
+Every user has a hash holding the number of unread entries of each of their
+feeds and categories, so that pages get all the counts in one round trip
+instead of aggregating ``Feed.unread_count`` in the database.
+
+The counts are updated along with ``Feed.unread_count`` and the hash is
+rebuilt from the database when it's missing. Changes that move counts around
+(marking everything as read, adding, moving or deleting feeds) just drop the
+hash.
+"""
+from ..utils import get_redis_connection
+
+KEY = 'unread:%s'
+# Set when the hash is built from the database. Increments on a missing hash
+# create an incomplete one, which is rebuilt when it's read.
+BUILT = 'built'
+TIMEOUT = 3600 * 24 * 7
+
+
+class UnreadCounts(object):
+    def __init__(self, feeds, categories):
+        self.feeds = feeds
+        self.categories = categories
+        self.total = sum(categories.values())
+
+    def feed(self, pk):
+        return self.feeds.get(pk, 0)
+
+    def category(self, pk):
+        return self.categories.get(pk, 0)
+
+
+def get_counts(user_id):
+    """Returns the ``UnreadCounts`` of a user"""
+    values = get_redis_connection().hgetall(KEY % user_id)
+    if BUILT not in values:
+        return rebuild(user_id)
+    feeds = {}
+    categories = {}
+    for field, value in values.items():
+        kind, sep, pk = field.partition(':')
+        if kind == 'feed':
+            feeds[int(pk)] = max(0, int(value))
+        elif kind == 'category':
+            categories[int(pk)] = max(0, int(value))
+    return UnreadCounts(feeds, categories)
+
+
+def get_request_counts(request):
+    """The counts of the current user, fetched once per request"""
+    if not hasattr(request, '_unread_counts'):
+        request._unread_counts = get_counts(request.user.pk)
+    return request._unread_counts
+
+
+def rebuild(user_id):
+    from .models import Feed
+    feeds = {}
+    categories = {}
+    for pk, category_id, count in Feed.objects.filter(
+        category__user=user_id,
+    ).values_list('pk', 'category', 'unread_count'):
+        feeds[pk] = count
+        categories[category_id] = categories.get(category_id, 0) + count
+
+    mapping = {BUILT: 1}
+    for pk, count in feeds.items():
+        mapping['feed:%s' % pk] = count
+    for pk, count in categories.items():
+        mapping['category:%s' % pk] = count
+    key = KEY % user_id
+    pipe = get_redis_connection().pipeline()
+    pipe.delete(key)
+    pipe.hmset(key, mapping)
+    pipe.expire(key, TIMEOUT)
+    pipe.execute()
+    return UnreadCounts(feeds, categories)
+
+
+def incr(user_id, feed_id, category_id, delta):
+    key = KEY % user_id
+    pipe = get_redis_connection().pipeline()
+    pipe.hincrby(key, 'feed:%s' % feed_id, delta)
+    pipe.hincrby(key, 'category:%s' % category_id, delta)
+    pipe.expire(key, TIMEOUT)
+    pipe.execute()
+
+
+def invalidate(*user_ids):
+    if user_ids:
+        get_redis_connection().delete(*[KEY % pk for pk in user_ids])
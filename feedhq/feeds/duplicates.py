@@ -0,0 +1,167 @@
+"""
+Near-duplicate detection for entries.
+
+Each piece of content gets a 64-bit SimHash fingerprint of its title and text.
+Syndicated copies of the same article (planets, aggregators, feed proxies) end
+up with fingerprints that differ by only a few bits, even if their links were
+rewritten.
+
+New entries are checked in bulk when feeds are updated. Their links are
+looked up among all the entries of the user in the database. Their
+fingerprints are compared to the ones of the user's most recent entries,
+kept in a Redis list per user. Updates only push to the list, so that
+concurrent updates for the same user don't lose each other's entries.
+"""
+import hashlib
+import re
+
+from ..utils import get_redis_connection
+
+BITS = 64
+MASK = (1 << BITS) - 1
+
+# Fingerprints within DISTANCE bits of each other are near-duplicates
+DISTANCE = 3
+# Pigeonhole: two fingerprints within DISTANCE bits share at least one of
+# DISTANCE + 1 blocks exactly.
+BLOCKS = DISTANCE + 1
+BLOCK_BITS = BITS // BLOCKS
+
+SHINGLE_SIZE = 3
+# Short texts don't have enough features for a meaningful fingerprint
+MIN_WORDS = 30
+
+INDEX_KEY = 'duplicates:%s'
+INDEX_SIZE = 1000
+INDEX_TIMEOUT = 3600 * 24 * 7
+# Tail of the list once it's filled from the database. Trimmed away when the
+# list is full.
+SENTINEL = 'built'
+
+WORDS_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _hash(feature):
+    return int(hashlib.md5(feature.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def fingerprint(text):
+    """
+    Returns the SimHash of ``text`` as a signed 64-bit integer (suitable for
+    a BigIntegerField), or None if the text is too short.
+    """
+    words = WORDS_RE.findall(text.lower())
+    if len(words) < MIN_WORDS:
+        return None
+    shingles = [u' '.join(words[i:i + SHINGLE_SIZE])
+                for i in range(len(words) - SHINGLE_SIZE + 1)]
+    rows = [format(_hash(shingle), '064b') for shingle in shingles]
+    half = len(rows) / 2.
+    bits = ''.join(['1' if column.count('1') > half else '0'
+                    for column in zip(*rows)])
+    value = int(bits, 2)
+    if value >= 1 << (BITS - 1):
+        value -= 1 << BITS
+    return value
+
+
+def distance(first, second):
+    """Hamming distance between two fingerprints"""
+    return bin((first ^ second) & MASK).count('1')
+
+
+def blocks(value):
+    value &= MASK
+    return [(i, (value >> (i * BLOCK_BITS)) & ((1 << BLOCK_BITS) - 1))
+            for i in range(BLOCKS)]
+
+
+def invalidate(user_id):
+    """Drops the index of a user, rebuilt from the database when it's loaded"""
+    get_redis_connection().delete(INDEX_KEY % user_id)
+
+
+class DuplicateIndex(object):
+    """
+    The fingerprints of a user's recent entries and the links the user
+    already has. Fingerprints are bucketed by block so that lookups only
+    compare a handful of candidates.
+    """
+    def __init__(self, user_id, values, links=()):
+        self.user_id = user_id
+        self.links = set(links)
+        self.buckets = {}
+        # Fingerprints added since the index was loaded
+        self.new = []
+        for value in values:
+            self._add(value)
+
+    @classmethod
+    def load(cls, user_id, links=()):
+        """
+        Loads the index of a user. ``links`` are the links of the new
+        entries, the ones the user already has are looked up in the database.
+        """
+        from .models import Entry
+        conn = get_redis_connection()
+        key = INDEX_KEY % user_id
+        values = conn.lrange(key, 0, -1)
+        if SENTINEL not in values and len(values) < INDEX_SIZE:
+            # Appended after what updates pushed meanwhile, which is newer
+            rows = list(Entry.objects.filter(
+                user=user_id, content__fingerprint__isnull=False,
+            ).order_by('-date', '-pk').values_list(
+                'content__fingerprint', flat=True,
+            )[:INDEX_SIZE])
+            pipe = conn.pipeline()
+            pipe.rpush(key, *(rows + [SENTINEL]))
+            pipe.ltrim(key, 0, INDEX_SIZE - 1)
+            pipe.expire(key, INDEX_TIMEOUT)
+            pipe.execute()
+            values.extend(rows)
+        values = [int(value) for value in values if value != SENTINEL]
+
+        links = [link for link in set(links) if link]
+        if links:
+            links = Entry.objects.filter(
+                user=user_id, content__link__in=links,
+            ).values_list('content__link', flat=True)
+        return cls(user_id, values, links)
+
+    def save(self):
+        """Pushes the fingerprints added since the index was loaded"""
+        if not self.new:
+            return
+        key = INDEX_KEY % self.user_id
+        pipe = get_redis_connection().pipeline()
+        pipe.lpush(key, *self.new)
+        pipe.ltrim(key, 0, INDEX_SIZE - 1)
+        pipe.expire(key, INDEX_TIMEOUT)
+        pipe.execute()
+        self.new = []
+
+    def _add(self, value):
+        for block in blocks(value):
+            self.buckets.setdefault(block, []).append(value)
+
+    def add(self, content):
+        if content.link:
+            self.links.add(content.link)
+        if content.fingerprint is not None:
+            self._add(content.fingerprint)
+            self.new.append(content.fingerprint)
+
+    def contains(self, content):
+        """
+        Whether ``content`` has the same link as an entry of the user, or is
+        a near-duplicate of an indexed entry.
+        """
+        if content.link and content.link in self.links:
+            return True
+        if content.fingerprint is None:
+            return False
+        for block in blocks(content.fingerprint):
+            for value in self.buckets.get(block, ()):
+                if distance(value, content.fingerprint) <= DISTANCE:
+                    return True
+        return False
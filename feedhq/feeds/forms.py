@@ -44,7 +44,7 @@ class CategoryForm(forms.ModelForm):
 class FeedForm(forms.ModelForm):
     class Meta:
         model = Feed
-        fields = ('name', 'url', 'category', 'muted')
+        fields = ('name', 'url', 'category', 'muted', 'keep_last')
 
     def clean_url(self):
         url = self.cleaned_data['url']
@@ -78,6 +78,11 @@ class ReadForm(forms.Form):
     ), widget=forms.HiddenInput, initial='read')
 
 
+class SearchForm(forms.Form):
+    q = forms.CharField(label=_('Search'), max_length=255,
+                        widget=forms.SearchInput)
+
+
 class SubscriptionForm(forms.Form):
     subscribe = forms.BooleanField(label=_('Subscribe?'), required=False)
     name = forms.CharField(label=_('Name'))
@@ -0,0 +1,67 @@
+"""
+Generation of what a user sees, kept in Redis.
+
+Rendered fragments (header, entry lists, dashboard) are cached with the
+user's generation in their key. Anything that changes what the user sees
+(new entries, read state, subscriptions, settings) bumps the generation, a
+single INCR, and the fragments of the previous generation are never read
+again. They expire after ``FRAGMENT_TIMEOUT``.
+
+The generation is also the validator of the pages built from the same data,
+which answer conditional GETs without loading anything else.
+"""
+import hashlib
+import time
+
+from django.contrib import messages
+from django.utils import translation
+from django.utils.encoding import force_bytes
+
+from ..utils import get_redis_connection
+
+KEY = 'generation:%s'
+FRAGMENT_TIMEOUT = 3600 * 24
+
+
+def get_generation(user_id):
+    conn = get_redis_connection()
+    key = KEY % user_id
+    value = conn.get(key)
+    if value is None:
+        # Not a small number, which is what bumping a missing key gives:
+        # fragments of the previous generations can't be reused.
+        conn.setnx(key, int(time.time() * 1000))
+        value = conn.get(key)
+    return int(value)
+
+
+def get_request_generation(request):
+    """The generation of the current user, fetched once per request"""
+    if not hasattr(request, '_generation'):
+        request._generation = get_generation(request.user.pk)
+    return request._generation
+
+
+def bump(*user_ids):
+    pipe = get_redis_connection().pipeline(transaction=False)
+    for pk in set(user_ids):
+        pipe.incr(KEY % pk)
+    pipe.execute()
+
+
+def etag(request, *args, **kwargs):
+    """
+    ETag of a page showing what bumps the user's generation, for the
+    ``condition`` decorator. None (no conditional GET) when there are
+    messages to show. Fragments served to AJAX requests have their own.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    if not request.user.is_authenticated() or len(
+            messages.get_messages(request)):
+        return None
+    return hashlib.md5(force_bytes('%s:%s:%s:%s:%s' % (
+        request.user.pk, get_request_generation(request),
+        translation.get_language(), request.is_ajax(),
+        request.get_full_path(),
+    ))).hexdigest()
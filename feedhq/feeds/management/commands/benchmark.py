@@ -0,0 +1,173 @@
+import bleach
+import datetime
+import feedparser
+import lxml.etree
+import lxml.html
+import os
+import re
+import time
+
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.template import Context, Template
+from django.utils import timezone
+
+from ... import pipeline
+from ...sanitizers import BleachSanitizer, LxmlSanitizer
+from ...models import Category, Entry, Feed, UniqueEntry
+from ...utils import FeedUpdater
+
+MEDIA_RE = re.compile(r'.*<(img|audio|video)\s+.*', re.UNICODE | re.DOTALL)
+
+# Entry rows as they were rendered before get_rows()
+ENTRY_TEMPLATE = (
+    '{% for entry in entries %}'
+    '<li class="entry{% if not entry.is_read %} new{% endif%}">'
+    '<div class="title ellipsis"{% if entry.feed.favicon %} style="'
+    'background-image: url(\'{{ entry.feed.favicon.url }}\');"{% endif %}>'
+    '<a href="{% if only_unread %}'
+    '{% url "feeds:unread_feed" entry.feed.pk %}{% else %}'
+    '{% url "feeds:feed" entry.feed.pk %}{% endif %}" '
+    'class="cat {{ entry.feed.category.color }}">{{ entry.feed }}</a>'
+    '<a href="{% url "feeds:item" entry.id %}'
+    '?back={{ list_url|urlencode:"" }}">'
+    '{{ entry.content.sanitized_title|default:_("(No title)")|safe }}</a>'
+    '</div>'
+    '<div class="date">{{ entry.date|timezone:user.timezone|date }}</div>'
+    '</li>{% endfor %}'
+)
+
+ROW_TEMPLATE = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                            'templates', 'feeds', 'entry_include.html')
+
+
+def multiparse(content):
+    """The HTML processing path before the single-pass pipeline: lxml at
+    ingestion, then bleach twice and a regex when rendering."""
+    page = lxml.html.fromstring(u'<div>%s</div>' % content)
+    for element in page.iter('img'):
+        el_str = lxml.etree.tostring(element)
+        if 'width="1"' in el_str or 'width="0"' in el_str:
+            element.drop_tree()
+    html = lxml.etree.tostring(page)
+    bleach.clean(html, tags=UniqueEntry.ELEMENTS,
+                 attributes=UniqueEntry.ATTRIBUTES,
+                 styles=UniqueEntry.CSS_PROPERTIES, strip=True)
+    bleach.clean(html, tags=UniqueEntry.ELEMENTS - pipeline.MEDIA_TAGS,
+                 attributes=UniqueEntry.ATTRIBUTES,
+                 styles=UniqueEntry.CSS_PROPERTIES, strip=True)
+    MEDIA_RE.match(html)
+
+
+class Command(BaseCommand):
+    """Benchmarks the processing of entry content"""
+    args = '<benchmark> <feed file> [<feed file> ...]'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--iterations',
+            action='store',
+            type='int',
+            dest='iterations',
+            default=5,
+            help='Number of runs over the whole set of entries',
+        ),
+    )
+
+    def get_benchmarks(self):
+        whitelists = (UniqueEntry.ELEMENTS, UniqueEntry.ATTRIBUTES,
+                      UniqueEntry.CSS_PROPERTIES)
+        return {
+            'pipeline': [
+                ('multi-parse', multiparse),
+                ('pipeline', pipeline.process),
+            ],
+            'sanitizer': [
+                ('bleach', BleachSanitizer(*whitelists).clean),
+                ('lxml', LxmlSanitizer(*whitelists).clean),
+            ],
+        }
+
+    def handle(self, *args, **kwargs):
+        benchmarks = self.get_benchmarks()
+        names = sorted(list(benchmarks) + ['rows'])
+        if len(args) < 2 or args[0] not in names:
+            raise CommandError("Usage: benchmark <%s> <feed file> "
+                               "[<feed file> ...]" % '|'.join(names))
+
+        parsed = [feedparser.parse(path) for path in args[1:]]
+        if args[0] == 'rows':
+            return self.benchmark_rows(parsed, kwargs['iterations'])
+
+        contents = []
+        for feed in parsed:
+            for entry in feed.entries:
+                contents.append(FeedUpdater.get_content(entry))
+        size = sum([len(c.encode('utf-8')) for c in contents])
+        megabytes = size * kwargs['iterations'] / 1024. / 1024.
+
+        self.stdout.write("%s entries, %.1f kB of HTML\n" % (
+            len(contents), size / 1024.))
+        for name, function in benchmarks[args[0]]:
+            start = time.time()
+            for i in range(kwargs['iterations']):
+                for content in contents:
+                    function(content)
+            elapsed = time.time() - start
+            self.stdout.write(
+                "%s: %.1f entries/s, %.2f s/MB\n" % (
+                    name, len(contents) * kwargs['iterations'] / elapsed,
+                    elapsed / megabytes))
+
+    def benchmark_rows(self, parsed, iterations):
+        """
+        Renders pages of 100 entry rows from the entries of the feed files,
+        with the template lookups of each row or with the rows prepared by
+        the view. Nothing is read from or written to the database.
+        """
+        from ...views import get_rows
+        user = User(timezone='Europe/Paris')
+        now = timezone.now()
+        entries = []
+        for index, parsed_feed in enumerate(parsed):
+            category = Category(pk=index + 1, color='blue')
+            feed = Feed(pk=index + 1, name=parsed_feed.feed.get('title', ''),
+                        category=category, favicon='favicons/feed.png')
+            for entry in parsed_feed.entries:
+                entries.append(Entry(
+                    pk=len(entries) + 1, feed=feed, category=category,
+                    date=now - datetime.timedelta(hours=len(entries)),
+                    content=UniqueEntry(sanitized_title=bleach.clean(
+                        entry.get('title', ''), tags=[], strip=True)),
+                ))
+        if not entries:
+            raise CommandError("No entries in the feed files")
+        # Pages of 100 rows, the entries are repeated if there are less
+        entries = entries * (100 / len(entries) + 1)
+        pages = [entries[i:i + 100]
+                 for i in range(0, len(entries) - 99, 100)]
+
+        with open(ROW_TEMPLATE) as template:
+            rows = Template('{% for row in rows %}' + template.read() +
+                            '{% endfor %}')
+        entries = Template(ENTRY_TEMPLATE)
+        context = {'user': user, 'only_unread': False, 'list_url': '/'}
+
+        def render_entries(page):
+            entries.render(Context(dict(context, entries=page)))
+
+        def render_rows(page):
+            rows.render(Context(dict(context, rows=get_rows(
+                page, user, False, '/'))))
+
+        self.stdout.write("%s pages of 100 entries\n" % len(pages))
+        for name, function in [('entries', render_entries),
+                               ('rows', render_rows)]:
+            start = time.time()
+            for i in range(iterations):
+                for page in pages:
+                    function(page)
+            elapsed = time.time() - start
+            self.stdout.write("%s: %.2f ms per 100 rows\n" % (
+                name, elapsed * 1000 / (len(pages) * iterations)))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from ... import counters
+from ...models import Category, Entry, Feed
+
+
+class Command(BaseCommand):
+    """Repairs the unread counts that drifted from the actual entries"""
+
+    def handle(self, *args, **kwargs):
+        counts = dict(Entry.objects.unread().values_list(
+            'feed',
+        ).annotate(count=Count('pk')).order_by())
+
+        fixed = 0
+        for pk, unread_count in Feed.objects.values_list('pk',
+                                                         'unread_count'):
+            actual = counts.get(pk, 0)
+            if unread_count == actual:
+                continue
+            # Only fix the count if it hasn't changed in the meantime
+            fixed += Feed.objects.filter(
+                pk=pk, unread_count=unread_count,
+            ).update(unread_count=actual)
+        # The counts in Redis may have drifted as well
+        counters.invalidate(*Category.objects.values_list(
+            'user', flat=True).distinct())
+        self.stdout.write("%s unread counts fixed\n" % fixed)
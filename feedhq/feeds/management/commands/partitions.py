@@ -0,0 +1,66 @@
+import datetime
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from ... import partitions
+
+
+class Command(BaseCommand):
+    """Creates the monthly partitions of the entries table (PostgreSQL)"""
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--months',
+            action='store',
+            type='int',
+            dest='months',
+            default=3,
+            help='Number of future months to create partitions for',
+        ),
+        make_option(
+            '--since',
+            action='store',
+            dest='since',
+            default=None,
+            help='Create partitions starting at this month (YYYY-MM) '
+                 'instead of the current one',
+        ),
+        make_option(
+            '--move',
+            action='store_true',
+            dest='move',
+            default=False,
+            help='Move the entries stored in the parent table to their '
+                 'partition',
+        ),
+    )
+
+    def handle(self, *args, **kwargs):
+        if not partitions.is_supported():
+            raise CommandError("Partitioning requires PostgreSQL")
+
+        month = partitions.month_start(timezone.now())
+        last = month
+        for i in range(kwargs['months']):
+            last = partitions.next_month(last)
+        if kwargs['since'] is not None:
+            try:
+                since = datetime.datetime.strptime(kwargs['since'], '%Y-%m')
+            except ValueError:
+                raise CommandError("Invalid month: %s" % kwargs['since'])
+            month = since.replace(tzinfo=timezone.utc)
+
+        created = moved = 0
+        with transaction.commit_on_success():
+            partitions.install()
+        while month <= last:
+            with transaction.commit_on_success():
+                created += partitions.create_partition(month)
+                if kwargs['move']:
+                    moved += partitions.move_rows(month)
+            month = partitions.next_month(month)
+        self.stdout.write("%s partitions created, %s entries moved\n" % (
+            created, moved))
@@ -0,0 +1,148 @@
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from ... import generations, partitions, sync
+from ...models import Category, Entry, Feed, UniqueEntry, TIMEDELTAS
+
+
+class Command(BaseCommand):
+    """
+    Deletes the entries that are past their category's retention period, or
+    beyond the number of entries to keep for their feed.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--chunk',
+            action='store',
+            type='int',
+            dest='chunk',
+            default=1000,
+            help='Number of rows to delete per transaction',
+        ),
+    )
+
+    def handle(self, *args, **kwargs):
+        self.chunk = kwargs['chunk']
+        # Number of unread entries deleted, per feed
+        self.unread = {}
+        start = time.time()
+
+        entries = (self.purge_partitions() + self.purge_expired() +
+                   self.purge_overflow())
+        for feed in Feed.objects.filter(
+            pk__in=self.unread.keys(),
+        ).select_related('category'):
+            feed.incr_unread_count(-self.unread[feed.pk])
+        contents = self.purge_orphans()
+
+        elapsed = time.time() - start
+        self.stdout.write(
+            "%s entries and %s orphaned contents purged in %.1fs "
+            "(%.0f rows/s)\n" % (entries, contents, elapsed,
+                                 (entries + contents) / max(elapsed, 0.001)))
+
+    def delete_chunks(self, queryset, fields=('pk',)):
+        """
+        Deletes the rows of ``queryset`` in short transactions of at most
+        ``self.chunk`` rows. Returns the values of ``fields`` for each
+        deleted row.
+        """
+        values = queryset.order_by('pk').values_list(*fields)
+        deleted = []
+        last_pk = 0
+        while True:
+            rows = list(values.filter(pk__gt=last_pk)[:self.chunk])
+            if not rows:
+                break
+            with transaction.commit_on_success():
+                # The conditions are checked again, rows may have changed
+                # since they were selected.
+                queryset.filter(pk__in=[row[0] for row in rows]).delete()
+            last_pk = rows[-1][0]
+            deleted.extend(rows)
+        return deleted
+
+    def purge_partitions(self):
+        """
+        Drops the partitions of the entries table that only contain entries
+        past the retention period of every category.
+        """
+        if not partitions.is_installed():
+            return 0
+        policies = set(Category.objects.values_list('delete_after',
+                                                    flat=True).distinct())
+        if not policies or not policies.issubset(TIMEDELTAS):
+            # Some entries are kept forever
+            return 0
+        threshold = timezone.now() - max([TIMEDELTAS[policy]
+                                          for policy in policies])
+        deleted = 0
+        for name, month in partitions.get_partitions():
+            if partitions.next_month(month) > threshold:
+                break
+            with transaction.commit_on_success():
+                unread, rows = partitions.drop_partition(name)
+            # The cached lists may show the deleted entries
+            generations.bump(*set(user for user, pk in rows))
+            sync.remove(rows)
+            for feed_id, unread_count in unread.items():
+                self.unread[feed_id] = (self.unread.get(feed_id, 0) +
+                                        unread_count)
+            deleted += len(rows)
+        return deleted
+
+    def delete_entries(self, queryset):
+        """Deletes entries in chunks, keeping track of the unread ones"""
+        rows = self.delete_chunks(queryset, fields=(
+            'pk', 'feed_id', 'read', 'feed__read_through',
+            'category__read_through', 'user_id',
+        ))
+        for pk, feed_id, read, feed_read_through, read_through, user in rows:
+            if not read and pk > max(feed_read_through, read_through):
+                self.unread[feed_id] = self.unread.get(feed_id, 0) + 1
+        # The cached lists may show the deleted entries
+        generations.bump(*[row[-1] for row in rows])
+        sync.remove([(row[-1], row[0]) for row in rows])
+        return len(rows)
+
+    def purge_expired(self):
+        now = timezone.now()
+        deleted = 0
+        for policy, delta in TIMEDELTAS.items():
+            deleted += self.delete_entries(Entry.objects.filter(
+                category__delete_after=policy,
+                date__lte=now - delta,
+            ))
+        return deleted
+
+    def purge_overflow(self):
+        deleted = 0
+        feeds = Feed.objects.filter(
+            Q(keep_last__isnull=False) |
+            Q(keep_last__isnull=True, category__keep_last__isnull=False),
+        ).select_related('category')
+        for feed in feeds:
+            keep_last = feed.get_keep_last()
+            # The most recent entry past the limit
+            oldest = feed.entries.order_by('-date', '-pk').values_list(
+                'date', 'pk',
+            )[keep_last:keep_last + 1]
+            if not oldest:
+                continue
+            date, pk = oldest[0]
+            deleted += self.delete_entries(feed.entries.filter(
+                Q(date__lt=date) | Q(date=date, pk__lte=pk),
+            ))
+        return deleted
+
+    def purge_orphans(self):
+        """Deletes the content no subscriber references anymore"""
+        return len(self.delete_chunks(UniqueEntry.objects.filter(
+            subscriptions__isnull=True,
+        )))
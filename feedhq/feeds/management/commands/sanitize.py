@@ -0,0 +1,54 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ... import search
+from ...models import UniqueEntry
+
+
+class Command(BaseCommand):
+    """
+    Regenerates the render-ready content sanitized by an older whitelist, and
+    indexes it for search
+    """
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--all',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Regenerate the content of all entries',
+        ),
+        make_option(
+            '--chunk',
+            action='store',
+            type='int',
+            dest='chunk',
+            default=500,
+            help='Number of entries to process per transaction',
+        ),
+    )
+
+    def handle(self, *args, **kwargs):
+        entries = UniqueEntry.objects.order_by('pk')
+        if not kwargs['all']:
+            entries = entries.exclude(
+                sanitizer_version=UniqueEntry.SANITIZER_VERSION,
+            )
+
+        done = 0
+        last_pk = 0
+        while True:
+            chunk = list(entries.filter(pk__gt=last_pk)[:kwargs['chunk']])
+            if not chunk:
+                break
+            with transaction.commit_on_success():
+                for entry in chunk:
+                    entry.sanitize()
+                    entry.save(update_fields=UniqueEntry.SANITIZED_FIELDS)
+                # Indexed with the text extracted by the pipeline
+                search.index(chunk)
+            last_pk = chunk[-1].pk
+            done += len(chunk)
+        self.stdout.write("%s entries sanitized\n" % done)
@@ -0,0 +1,137 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.db import connection, transaction
+
+from ...models import Category, Entry, Feed, UniqueEntry, UniqueFeed
+
+INDEX_RE = re.compile(r'^CREATE INDEX "?(\w+)"? ON', re.IGNORECASE)
+
+# Entries used to hold their content. One content is kept per unique feed and
+# link (title for entries without a link), which is how ingestion matches
+# them.
+CONTENT_KEY = """
+    COALESCE(unique_feed.id, 0),
+    lower(CASE WHEN entry.link = '' THEN entry.title ELSE entry.link END)
+"""
+
+CONTENTS_SQL = """
+INSERT INTO {uniqueentry} (
+    feed_id, title, subtitle, link, permalink, date,
+    sanitized_title, sanitized_content, sanitized_nomedia_content, has_media,
+    excerpt, link_domain, sanitizer_version
+)
+SELECT DISTINCT ON ({key})
+    unique_feed.id, entry.title, entry.subtitle, entry.link,
+    entry.permalink, entry.date, '', '', '', false, '', '', 0
+FROM {entry} entry
+JOIN {feed} feed ON feed.id = entry.feed_id
+LEFT JOIN {uniquefeed} unique_feed ON unique_feed.url = feed.url
+ORDER BY {key}, entry.date, entry.id
+"""
+
+BACKFILL_SQL = """
+CREATE TEMPORARY TABLE upgrade_contents AS
+SELECT COALESCE(feed_id, 0) AS unique_feed_id,
+    lower(CASE WHEN link = '' THEN title ELSE link END) AS key, id
+FROM {uniqueentry};
+CREATE INDEX upgrade_contents_key ON upgrade_contents (unique_feed_id, key);
+
+UPDATE {entry} entry SET content_id = content.id,
+    category_id = feed.category_id
+FROM {feed} feed
+LEFT JOIN {uniquefeed} unique_feed ON unique_feed.url = feed.url,
+    upgrade_contents content
+WHERE feed.id = entry.feed_id
+    AND content.unique_feed_id = COALESCE(unique_feed.id, 0)
+    AND content.key = lower(
+        CASE WHEN entry.link = '' THEN entry.title ELSE entry.link END);
+
+DROP TABLE upgrade_contents;
+"""
+
+
+class Command(BaseCommand):
+    """
+    Upgrades the database of an existing install to the current schema
+    (PostgreSQL). ``syncdb`` only creates the new tables: this adds the new
+    columns, moves the content of the entries to ``UniqueEntry`` and creates
+    the missing indexes. Steps that are already done are skipped.
+    """
+
+    def handle(self, *args, **kwargs):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Upgrading requires PostgreSQL")
+        self.cursor = connection.cursor()
+        with transaction.commit_on_success():
+            self.upgrade()
+        self.stdout.write("Database upgraded. Run the sanitize command with "
+                          "--all to process the content of the entries.\n")
+
+    def upgrade(self):
+        for model in Category, Feed:
+            table = model._meta.db_table
+            if not self.has_column(table, 'keep_last'):
+                self.run_sql("""
+                    ALTER TABLE {0}
+                    ADD COLUMN keep_last integer CHECK (keep_last >= 0),
+                    ADD COLUMN read_through integer NOT NULL DEFAULT 0
+                        CHECK (read_through >= 0);
+                    ALTER TABLE {0} ALTER COLUMN read_through DROP DEFAULT;
+                """.format(table))
+
+        tables = {
+            'entry': Entry._meta.db_table,
+            'uniqueentry': UniqueEntry._meta.db_table,
+            'feed': Feed._meta.db_table,
+            'uniquefeed': UniqueFeed._meta.db_table,
+            'category': Category._meta.db_table,
+            'key': CONTENT_KEY,
+        }
+        if self.has_column(tables['entry'], 'subtitle'):
+            self.run_sql("""
+                ALTER TABLE {entry}
+                ADD COLUMN content_id integer REFERENCES {uniqueentry} (id)
+                    DEFERRABLE INITIALLY DEFERRED,
+                ADD COLUMN category_id integer REFERENCES {category} (id)
+                    DEFERRABLE INITIALLY DEFERRED;
+            """.format(**tables))
+            self.run_sql(CONTENTS_SQL.format(**tables))
+            self.run_sql(BACKFILL_SQL.format(**tables))
+            # Tables with pending deferred constraint checks can't be altered
+            self.run_sql("SET CONSTRAINTS ALL IMMEDIATE")
+            self.run_sql("""
+                ALTER TABLE {entry}
+                ALTER COLUMN content_id SET NOT NULL,
+                ALTER COLUMN category_id SET NOT NULL,
+                DROP COLUMN title, DROP COLUMN subtitle, DROP COLUMN link,
+                DROP COLUMN permalink;
+            """.format(**tables))
+
+        style = no_style()
+        statements = []
+        for model in Entry, UniqueEntry:
+            statements += connection.creation.sql_indexes_for_model(model,
+                                                                    style)
+        statements += custom_sql_for_model(Entry, style, connection)
+        for statement in statements:
+            match = INDEX_RE.match(statement.strip())
+            if match is not None and not self.has_index(match.group(1)):
+                self.run_sql(statement)
+
+    def run_sql(self, sql):
+        self.cursor.execute(sql)
+
+    def has_column(self, table, column):
+        self.cursor.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = %s AND column_name = %s
+        """, [table, column])
+        return self.cursor.fetchone() is not None
+
+    def has_index(self, name):
+        self.cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                            [name])
+        return self.cursor.fetchone() is not None
@@ -12,7 +12,8 @@ import random
 import requests
 import socket
 
-from django.db import models
+from django.db import connection, models
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files.base import ContentFile
@@ -22,7 +23,10 @@ from django.utils.translation import ugettext_lazy as _
 
 from django_push.subscriber.signals import updated
 
-from .tasks import update_feed, update_unique_feed
+from . import (counters, duplicates, generations, pipeline, search, sync,
+               timelines)
+from .tasks import (compact_watermark, flag_read, update_feed,
+                    update_unique_feed)
 from .utils import FeedUpdater, FAVICON_FETCHER, USER_AGENT
 from ..storage import OverwritingStorage
 from ..tasks import enqueue
@@ -71,13 +75,6 @@ TIMEDELTAS = {
 }
 
 
-class CategoryManager(models.Manager):
-
-    def with_unread_counts(self):
-        return self.values('id', 'name', 'slug', 'color').annotate(
-            unread_count=models.Sum('feeds__unread_count'))
-
-
 class Category(models.Model):
     """Used to sort our feeds"""
     name = models.CharField(_('Name'), max_length=50)
@@ -97,8 +94,14 @@ class Category(models.Model):
         help_text=_("Period of time after which entries are deleted, whether "
                     "they've been read or not."),
     )
-
-    objects = CategoryManager()
+    # ... and/or when there are too many of them
+    keep_last = models.PositiveIntegerField(
+        _('Keep last'), null=True, blank=True,
+        help_text=_("Maximum number of entries to keep per feed, whether "
+                    "they've been read or not. Leave empty to keep them all."),
+    )
+    # Entries up to this id are read, see Entry.is_read
+    read_through = models.PositiveIntegerField(default=0, editable=False)
 
     def __unicode__(self):
         return u'%s' % self.name
@@ -110,6 +113,12 @@ class Category(models.Model):
     def get_absolute_url(self):
         return reverse('feeds:category', args=[self.slug])
 
+    def get_treshold(self):
+        """Returns the date after which the entries can be ignored / deleted"""
+        if self.delete_after == 'never':
+            return None
+        return timezone.now() - TIMEDELTAS[self.delete_after]
+
 
 class UniqueFeedManager(models.Manager):
     def update_feed(self, url, use_etags=True):
@@ -195,6 +204,7 @@ class UniqueFeedManager(models.Manager):
                 Feed.objects.filter(url=obj.url).update(url=redirection)
                 if self.filter(url=redirection).exists():
                     obj.delete()
+                    obj = self.get(url=redirection)
                     save = False
                 else:
                     obj.url = redirection
@@ -263,7 +273,8 @@ class UniqueFeedManager(models.Manager):
         if save:
             obj.save()
 
-        updater = FeedUpdater(parsed=parsed, feeds=feeds, hub=obj.hub)
+        updater = FeedUpdater(parsed=parsed, feeds=feeds, hub=obj.hub,
+                              unique=obj)
         updater.update()
 
 
@@ -356,6 +367,13 @@ class Feed(models.Model):
                                 storage=OverwritingStorage())
     img_safe = models.BooleanField(_('Display images by default'),
                                    default=False)
+    keep_last = models.PositiveIntegerField(
+        _('Keep last'), null=True, blank=True,
+        help_text=_("Maximum number of entries to keep for this feed. Leave "
+                    "empty to use the category setting."),
+    )
+    # Entries up to this id are read, see Entry.is_read
+    read_through = models.PositiveIntegerField(default=0, editable=False)
 
     def __unicode__(self):
         return u'%s' % self.name
@@ -372,6 +390,25 @@ class Feed(models.Model):
         if update:
             enqueue(update_feed, args=[self.url], kwargs={'use_etags': False},
                     timeout=20, queue='high')
+        else:
+            # The feed may have moved to another category. Watermarks only
+            # cover the entries of their category: the entries read through
+            # the old one are flagged as read, and the new one is compacted
+            # so that it doesn't cover the unread entries moving in.
+            moved = self.entries.exclude(category=self.category_id)
+            if moved.exists():
+                for pk, read_through in Category.objects.filter(
+                    pk__in=moved.order_by().values('category'),
+                    read_through__gt=0,
+                ).values_list('pk', 'read_through'):
+                    flag_read(moved.filter(category=pk,
+                                           pk__lte=read_through))
+                for read_through in Category.objects.filter(
+                    pk=self.category_id, read_through__gt=0,
+                ).values_list('read_through', flat=True):
+                    compact_watermark(Category, self.category_id,
+                                      read_through)
+                moved.update(category=self.category_id)
         enqueue(update_unique_feed, args=[self.url], timeout=20)
 
     @property
@@ -386,46 +423,148 @@ class Feed(models.Model):
 
     def get_treshold(self):
         """Returns the date after which the entries can be ignored / deleted"""
-        del_after = self.category.delete_after
+        return self.category.get_treshold()
 
-        if del_after == 'never':
-            return None
-        return timezone.now() - TIMEDELTAS[del_after]
+    def get_keep_last(self):
+        """Returns the number of entries to keep, None for no limit"""
+        if self.keep_last is not None:
+            return self.keep_last
+        return self.category.keep_last
 
-    def update_unread_count(self):
-        self.unread_count = self.entries.filter(read=False).count()
-        Feed.objects.filter(pk=self.pk).update(
-            unread_count=self.unread_count,
-        )
+    def incr_unread_count(self, delta=1):
+        """
+        Atomically adds ``delta`` to the unread count, which never goes below
+        0. Drift is repaired by the ``fixcounts`` management command.
 
+        The user's counts in Redis and generation are updated as well.
+        """
+        if delta == 0:
+            return
+        user_id = self.category.user_id
+        updated = Feed.objects.filter(
+            pk=self.pk, unread_count__gte=max(0, -delta),
+        ).update(unread_count=models.F('unread_count') + delta)
+        if updated:
+            counters.incr(user_id, self.pk, self.category_id, delta)
+        else:
+            Feed.objects.filter(pk=self.pk).update(unread_count=0)
+            counters.invalidate(user_id)
+        generations.bump(user_id)
+        self.unread_count = max(0, self.unread_count + delta)
+
+
+def invalidate_user_caches(user_id):
+    """
+    Drops the unread counts, timelines, fragments and duplicate index of a
+    user
+    """
+    counters.invalidate(user_id)
+    duplicates.invalidate(user_id)
+    timelines.invalidate(user_id, Category.objects.filter(
+        user=user_id).values_list('pk', flat=True))
+    generations.bump(user_id)
+
+
+def invalidate_feed_caches(sender, instance, **kwargs):
+    try:
+        user_id = instance.category.user_id
+    except Category.DoesNotExist:
+        # Deleted with its category
+        return
+    invalidate_user_caches(user_id)
+post_save.connect(invalidate_feed_caches, sender=Feed)
+post_delete.connect(invalidate_feed_caches, sender=Feed)
 
-class EntryManager(models.Manager):
-    def unread(self):
-        return self.filter(read=False).count()
 
+def list_feed_entries(sender, instance, **kwargs):
+    # Listed before the entries are deleted with the feed
+    instance.deleted_entries = list(instance.entries.values_list('user_id',
+                                                                 'pk'))
+pre_delete.connect(list_feed_entries, sender=Feed)
 
-class Entry(models.Model):
-    """An entry is a cached feed item"""
-    feed = models.ForeignKey(Feed, verbose_name=_('Feed'),
-                             related_name='entries')
+
+def log_feed_entries(sender, instance, **kwargs):
+    """Lists the entries of a deleted feed in the sync log"""
+    sync.remove(getattr(instance, 'deleted_entries', []))
+post_delete.connect(log_feed_entries, sender=Feed)
+
+
+def invalidate_category_caches(sender, instance, **kwargs):
+    counters.invalidate(instance.user_id)
+    timelines.invalidate(instance.user_id, [instance.pk])
+    generations.bump(instance.user_id)
+post_delete.connect(invalidate_category_caches, sender=Category)
+
+
+def bump_category_generation(sender, instance, **kwargs):
+    generations.bump(instance.user_id)
+post_save.connect(bump_category_generation, sender=Category)
+
+
+def bump_user_generation(sender, instance, **kwargs):
+    # Time zone and entries per page are part of the fragments
+    generations.bump(instance.pk)
+post_save.connect(bump_user_generation, sender=User)
+
+
+class UniqueEntryManager(models.Manager):
+    def get_for_entry(self, unique, entry):
+        """
+        Returns the stored content matching ``entry`` for ``unique``, or
+        ``entry`` itself (unsaved) if we haven't seen it before.
+        """
+        if not entry.link:
+            params = {'title__iexact': entry.title}
+        else:
+            params = {'link__iexact': entry.link}
+        params['feed'] = unique
+        try:
+            return self.get(**params)
+        except self.model.DoesNotExist:
+            return entry
+        except self.model.MultipleObjectsReturned:
+            # Content is shared, keep the oldest copy and leave the others
+            # alone: they may still be referenced by some subscribers.
+            return self.filter(**params).order_by('date', 'pk')[0]
+
+
+class UniqueEntry(models.Model):
+    """
+    The content of a feed item, stored once for all the subscribers of a
+    ``UniqueFeed``. Per-user state lives in ``Entry``.
+    """
+    feed = models.ForeignKey(UniqueFeed, verbose_name=_('Unique feed'),
+                             related_name='entries', null=True,
+                             on_delete=models.SET_NULL)
     title = models.CharField(_('Title'), max_length=255)
     subtitle = models.TextField(_('Abstract'))
-    link = models.URLField(_('URL'), max_length=1023)
+    link = models.URLField(_('URL'), max_length=1023, db_index=True)
     # We also have a permalink for feed proxies (like FeedBurner). If the link
     # points to feedburner, the redirection (=real feed link) is put here
     permalink = models.URLField(_('Permalink'), max_length=1023, blank=True)
     date = models.DateTimeField(_('Date'), db_index=True)
-    # The User FK is redundant but this may be better for performance and if
-    # want to allow user input.
-    user = models.ForeignKey(User, verbose_name=(_('User')),
-                             related_name='entries')
-    # Mark something as read or unread
-    read = models.BooleanField(_('Read'), default=False, db_index=True)
-    # Read later: store the URL
-    read_later_url = models.URLField(_('Read later URL'), max_length=1023,
-                                     blank=True)
 
-    objects = EntryManager()
+    # Render-ready versions of the content, computed once at ingestion time.
+    # Bump SANITIZER_VERSION when the whitelists change and run the
+    # ``sanitize`` management command to regenerate them.
+    sanitized_title = models.TextField(_('Sanitized title'), blank=True)
+    sanitized_content = models.TextField(_('Sanitized content'), blank=True)
+    sanitized_nomedia_content = models.TextField(
+        _('Sanitized content without media'), blank=True,
+    )
+    has_media = models.BooleanField(_('Has media'), default=False)
+    excerpt = models.TextField(_('Excerpt'), blank=True)
+    link_domain = models.CharField(_('Link domain'), max_length=255,
+                                   blank=True)
+    sanitizer_version = models.PositiveIntegerField(_('Sanitizer version'),
+                                                    default=0, db_index=True)
+    # SimHash of the title and text, for near-duplicate detection
+    fingerprint = models.BigIntegerField(_('Fingerprint'), null=True,
+                                         blank=True)
+
+    objects = UniqueEntryManager()
+
+    SANITIZER_VERSION = 4
 
     ELEMENTS = (
         feedparser._HTMLSanitizer.acceptable_elements |
@@ -439,47 +578,162 @@ class Entry(models.Model):
     )
     CSS_PROPERTIES = feedparser._HTMLSanitizer.acceptable_css_properties
 
+    SANITIZED_FIELDS = ['subtitle', 'sanitized_title', 'sanitized_content',
+                        'sanitized_nomedia_content', 'has_media', 'excerpt',
+                        'link_domain', 'fingerprint', 'sanitizer_version']
+
+    class Meta:
+        verbose_name_plural = 'unique entries'
+
     def __unicode__(self):
         return u'%s' % self.title
 
-    def sanitized_title(self):
-        if self.title:
-            return bleach.clean(self.title, tags=[], strip=True)
-        return _('(No title)')
-
-    def sanitized_content(self):
-        return bleach.clean(
-            self.subtitle,
-            tags=self.ELEMENTS,
-            attributes=self.ATTRIBUTES,
-            styles=self.CSS_PROPERTIES,
-            strip=True,
-        )
+    def save(self, *args, **kwargs):
+        if self.sanitizer_version != self.SANITIZER_VERSION:
+            self.sanitize()
+        super(UniqueEntry, self).save(*args, **kwargs)
 
-    def sanitized_nomedia_content(self):
-        return bleach.clean(
-            self.subtitle,
-            tags=self.ELEMENTS - set(['img', 'audio', 'video']),
-            attributes=self.ATTRIBUTES,
-            styles=self.CSS_PROPERTIES,
-            strip=True,
+    def sanitize(self):
+        """
+        Runs the content through the HTML pipeline and populates the
+        render-ready fields.
+        """
+        document = pipeline.process(self.subtitle)
+        self.subtitle = document.inner_html
+        self.sanitized_title = bleach.clean(self.title, tags=[], strip=True)
+        self.sanitized_content = document.sanitized_content
+        self.sanitized_nomedia_content = document.sanitized_nomedia_content
+        self.has_media = document.has_media
+        self.excerpt = document.excerpt
+        self.link_domain = self.get_link_domain()
+        if document.text is None:
+            pipeline.extract_text(document)
+        # Not stored, indexed for search once the content is saved
+        self.text = document.text
+        self.fingerprint = duplicates.fingerprint(
+            u' '.join([self.title, self.text]))
+        self.sanitizer_version = self.SANITIZER_VERSION
+
+    def get_link(self):
+        if self.permalink:
+            return self.permalink
+        return self.link
+
+    def get_link_domain(self):
+        return urlparse.urlparse(self.get_link()).netloc[:255]
+
+
+class SearchTerm(models.Model):
+    """
+    A word of the title or text of a content, for the databases without
+    full-text search. See search.IndexSearch.
+    """
+    term = models.CharField(_('Term'), max_length=search.MAX_TERM_LENGTH)
+    content = models.ForeignKey(UniqueEntry, verbose_name=_('Content'),
+                                related_name='terms')
+
+    class Meta:
+        index_together = (
+            ('term', 'content'),
         )
 
+    def __unicode__(self):
+        return u'%s' % self.term
+
+
+def unread_lookups():
+    """
+    Filters for the unread entries: the ones that aren't flagged as read
+    and are above the read-through watermarks of their feed and category.
+    """
+    return {
+        'read': False,
+        'feed__read_through__lt': models.F('id'),
+        'category__read_through__lt': models.F('id'),
+    }
+
+
+class EntryManager(models.Manager):
+    def unread(self):
+        return self.filter(**unread_lookups())
+
+    def reserve_ids(self, count):
+        """
+        Takes ``count`` ids from the sequence of the entries table. On
+        PostgreSQL, inserts routed to a partition don't return the id of the
+        row: entries are inserted with their id.
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+            "FROM generate_series(1, %s)", [self.model._meta.db_table, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+class Entry(models.Model):
+    """
+    An entry is a feed item in a user's timeline. The content is shared
+    between subscribers, entries only hold the user-specific state.
+    """
+    feed = models.ForeignKey(Feed, verbose_name=_('Feed'),
+                             related_name='entries')
+    content = models.ForeignKey(UniqueEntry, verbose_name=_('Content'),
+                                related_name='subscriptions')
+    # Copied from the content so that timelines can be sorted without joins
+    date = models.DateTimeField(_('Date'), db_index=True)
+    # The User FK is redundant but this may be better for performance and if
+    # want to allow user input.
+    user = models.ForeignKey(User, verbose_name=(_('User')),
+                             related_name='entries')
+    # The feed's category, for category timelines without joins. Updated when
+    # the feed moves to another category.
+    category = models.ForeignKey(Category, verbose_name=_('Category'),
+                                 related_name='entries')
+    # Mark something as read or unread
+    read = models.BooleanField(_('Read'), default=False, db_index=True)
+    # Read later: store the URL
+    read_later_url = models.URLField(_('Read later URL'), max_length=1023,
+                                     blank=True)
+
+    objects = EntryManager()
+
+    def __unicode__(self):
+        return u'%s' % self.content
+
     class Meta:
-        # Display most recent entries first
-        ordering = ('-date', 'title')
+        # Display most recent entries first. Entries with the same date are
+        # ordered by id to keep pagination stable.
+        ordering = ('-date', '-id')
         verbose_name_plural = 'entries'
+        # Lists are filtered by user, category or feed, ordered by (date,
+        # id). See also sql/entry.postgresql_psycopg2.sql for the unread
+        # lists.
+        index_together = (
+            ('user', 'date', 'id'),
+            ('category', 'date', 'id'),
+            ('feed', 'date', 'id'),
+        )
 
-    def get_absolute_url(self):
-        return reverse('feeds:item', args=[self.id])
+    def save(self, *args, **kwargs):
+        if self.category_id is None:
+            self.category_id = self.feed.category_id
+        if self.pk is None and connection.vendor == 'postgresql':
+            self.pk = Entry.objects.reserve_ids(1)[0]
+            kwargs['force_insert'] = True
+        super(Entry, self).save(*args, **kwargs)
 
-    def get_link(self):
-        if self.permalink:
-            return self.permalink
-        return self.link
+    @property
+    def is_read(self):
+        """
+        Marking a whole feed or category as read only moves its
+        ``read_through`` watermark. The ``read`` flags of the entries below it
+        are set later, in the background.
+        """
+        return (self.read or self.pk <= self.feed.read_through or
+                self.pk <= self.feed.category.read_through)
 
-    def link_domain(self):
-        return urlparse.urlparse(self.get_link()).netloc
+    def get_absolute_url(self):
+        return reverse('feeds:item', args=[self.id])
 
     def read_later_domain(self):
         netloc = urlparse.urlparse(self.read_later_url).netloc
@@ -497,8 +751,8 @@ class Entry(models.Model):
         data = json.loads(self.user.read_later_credentials)
         data.update({
             'apikey': settings.API_KEYS['readitlater'],
-            'url': self.get_link(),
-            'title': self.title,
+            'url': self.content.get_link(),
+            'title': self.content.title,
         })
         # The readitlater API doesn't return anything back
         requests.post(url, data=data)
@@ -506,24 +760,24 @@ class Entry(models.Model):
     def add_to_readability(self):
         url = 'https://www.readability.com/api/rest/v1/bookmarks'
         client = self.oauth_client('readability')
-        params = {'url': self.get_link()}
+        params = {'url': self.content.get_link()}
         response, data = client.request(url, method='POST',
                                         body=urllib.urlencode(params))
         response, data = client.request(response['location'], method='GET')
         url = 'https://www.readability.com/articles/%s'
         self.read_later_url = url % json.loads(data)['article']['id']
-        self.save()
+        self.save(update_fields=['read_later_url'])
 
     def add_to_instapaper(self):
         url = 'https://www.instapaper.com/api/1/bookmarks/add'
         client = self.oauth_client('instapaper')
-        params = {'url': self.get_link()}
+        params = {'url': self.content.get_link()}
         response, data = client.request(url, method='POST',
                                         body=urllib.urlencode(params))
         url = 'https://www.instapaper.com/read/%s'
         url = url % json.loads(data)[0]['bookmark_id']
         self.read_later_url = url
-        self.save()
+        self.save(update_fields=['read_later_url'])
 
     def oauth_client(self, service):
         service_settings = getattr(settings, service.upper())
@@ -546,7 +800,8 @@ def pubsubhubbub_update(notification, **kwargs):
     if url is None:
         return
     feeds = Feed.objects.filter(url=url)
-    updater = FeedUpdater(parsed, feeds)
+    unique, created = UniqueFeed.objects.get_or_create(url=url)
+    updater = FeedUpdater(parsed, feeds, unique=unique)
     updater.update()
 updated.connect(pubsubhubbub_update)
 
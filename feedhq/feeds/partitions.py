@@ -0,0 +1,187 @@
+"""
+Monthly partitioning of the entries table on PostgreSQL.
+
+Entries are stored in child tables inheriting from the ``Entry`` table, one
+per month of ``date``. A BEFORE INSERT trigger routes the rows inserted in the
+parent table to their partition, so that each row is written once. Such
+inserts don't return the rows, entries are saved with an id taken from the
+sequence beforehand (see ``EntryManager.reserve_ids``).
+
+Queries on ``Entry`` go through the parent table and cover all the
+partitions. With constraint exclusion, the partitions that can't match a
+condition on ``date`` aren't scanned: lists only show the entries within the
+retention period of their categories (see ``retention_start``).
+
+Rows for which no partition exists (yet) stay in the parent table.
+"""
+import datetime
+import re
+
+from django.db import connection
+from django.utils import timezone
+
+from .models import Category, Entry, Feed
+
+TABLE = Entry._meta.db_table
+TRIGGER = '%s_partition' % TABLE
+NAME_RE = re.compile(r'^%s_y(\d{4})m(\d{2})$' % TABLE)
+
+INSTALL_SQL = """
+CREATE OR REPLACE FUNCTION {trigger}() RETURNS trigger AS $$
+DECLARE
+    partition text := '{table}_' || to_char(NEW.date AT TIME ZONE 'UTC',
+                                            '"y"YYYY"m"MM');
+BEGIN
+    PERFORM 1 FROM pg_class WHERE relname = partition AND relkind = 'r';
+    IF NOT FOUND THEN
+        -- No partition for this month, the row stays in the parent table
+        RETURN NEW;
+    END IF;
+    EXECUTE 'INSERT INTO ' || quote_ident(partition) || ' SELECT ($1).*'
+        USING NEW;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS {trigger} ON {table};
+CREATE TRIGGER {trigger} BEFORE INSERT ON {table}
+    FOR EACH ROW EXECUTE PROCEDURE {trigger}();
+"""
+
+CREATE_SQL = """
+CREATE TABLE {partition} (
+    LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING INDEXES,
+    CHECK (date >= '{start}' AND date < '{end}')
+);
+ALTER TABLE {partition} INHERIT {table};
+"""
+
+FOREIGN_KEY_SQL = """
+ALTER TABLE {partition} ADD FOREIGN KEY ({column})
+    REFERENCES {target} (id) DEFERRABLE INITIALLY DEFERRED;
+"""
+
+
+def is_supported():
+    return connection.vendor == 'postgresql'
+
+
+def retention_start(categories):
+    """
+    The date before which the entries of ``categories`` are past their
+    retention period and about to be purged, None if some are kept forever.
+    """
+    tresholds = [category.get_treshold() for category in categories]
+    if not tresholds or None in tresholds:
+        return None
+    return min(tresholds)
+
+
+def is_installed():
+    if not is_supported():
+        return False
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1 FROM pg_trigger WHERE tgname = %s", [TRIGGER])
+    return cursor.fetchone() is not None
+
+
+def install():
+    """Installs the trigger routing new rows to their partition"""
+    connection.cursor().execute(INSTALL_SQL.format(table=TABLE,
+                                                   trigger=TRIGGER))
+
+
+def month_start(date):
+    """The beginning of the month of ``date``, in UTC"""
+    date = timezone.localtime(date, timezone.utc)
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def partition_name(month):
+    return '%s_y%04dm%02d' % (TABLE, month.year, month.month)
+
+
+def get_partitions():
+    """Returns the existing partitions as (name, first month) tuples"""
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        WHERE parent.relname = %s
+    """, [TABLE])
+    partitions = []
+    for name, in cursor.fetchall():
+        match = NAME_RE.match(name)
+        if match is not None:
+            year, month = map(int, match.groups())
+            partitions.append((name, datetime.datetime(year, month, 1,
+                                                       tzinfo=timezone.utc)))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def create_partition(month):
+    """Creates the partition for ``month``. Returns False if it exists."""
+    name = partition_name(month)
+    if name in [partition for partition, start in get_partitions()]:
+        return False
+    cursor = connection.cursor()
+    cursor.execute(CREATE_SQL.format(
+        partition=name, table=TABLE,
+        start=month.isoformat(), end=next_month(month).isoformat(),
+    ))
+    # Foreign keys aren't inherited
+    for field in Entry._meta.fields:
+        if field.rel is None:
+            continue
+        cursor.execute(FOREIGN_KEY_SQL.format(
+            partition=name, column=field.column,
+            target=field.rel.to._meta.db_table,
+        ))
+    return True
+
+
+def move_rows(month):
+    """
+    Moves the rows for ``month`` stored in the parent table to their
+    partition. Returns the number of rows moved.
+    """
+    cursor = connection.cursor()
+    params = [month, next_month(month)]
+    cursor.execute("""
+        INSERT INTO {partition} SELECT * FROM ONLY {table}
+        WHERE date >= %s AND date < %s
+    """.format(partition=partition_name(month), table=TABLE), params)
+    cursor.execute("""
+        DELETE FROM ONLY {table} WHERE date >= %s AND date < %s
+    """.format(table=TABLE), params)
+    return cursor.rowcount
+
+
+def drop_partition(name):
+    """
+    Drops a partition. Returns the number of unread entries per feed and the
+    (user id, entry id) of the rows it contained.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT user_id, id FROM {0}".format(name))
+    deleted = cursor.fetchall()
+    cursor.execute("""
+        SELECT entry.feed_id, SUM(CASE
+            WHEN entry.read OR entry.id <= feed.read_through
+                OR entry.id <= category.read_through THEN 0
+            ELSE 1 END)
+        FROM {0} entry
+        JOIN {1} feed ON feed.id = entry.feed_id
+        JOIN {2} category ON category.id = entry.category_id
+        GROUP BY entry.feed_id
+    """.format(name, Feed._meta.db_table, Category._meta.db_table))
+    rows = cursor.fetchall()
+    # Tables with pending deferred constraint checks can't be dropped
+    cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+    cursor.execute("DROP TABLE {0}".format(name))
+    return dict(rows), deleted
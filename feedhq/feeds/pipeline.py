@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+HTML processing for entry content.
+
+Entry bodies are parsed once with lxml and the resulting tree goes through a
+list of stages. Each stage is a callable taking a ``Document`` and modifying
+its tree or populating its attributes.
+
+The stages can be customized with the ``HTML_PIPELINE`` setting, a list of
+dotted paths to callables. Defaults to ``DEFAULT_PIPELINE``.
+"""
+import lxml.etree
+import lxml.html
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from .sanitizers import MEDIA_TAGS, get_sanitizer, strip_media
+
+EXCERPT_LENGTH = 300
+
+DEFAULT_PIPELINE = (
+    'feedhq.feeds.pipeline.drop_tracking_pixels',
+    'feedhq.feeds.pipeline.detect_media',
+    'feedhq.feeds.pipeline.extract_text',
+    'feedhq.feeds.pipeline.extract_excerpt',
+    'feedhq.feeds.pipeline.sanitize',
+)
+
+
+class Document(object):
+    """An entry body, parsed once and shared by all the stages"""
+    def __init__(self, content):
+        self.tree = lxml.html.fragment_fromstring(content or u'',
+                                                  create_parent='div')
+        self.has_media = False
+        self.text = None
+        self.excerpt = u''
+        self.sanitized_content = u''
+        self.sanitized_nomedia_content = u''
+
+    @property
+    def html(self):
+        """The processed fragment, wrapped in a <div>"""
+        return lxml.etree.tostring(self.tree, encoding=unicode)
+
+    @property
+    def inner_html(self):
+        """The processed fragment, without the wrapping <div>"""
+        html = self.html
+        if html == u'<div/>':
+            return u''
+        return html[len(u'<div>'):-len(u'</div>')]
+
+
+def drop_tracking_pixels(document):
+    for element in list(document.tree.iter('img')):
+        width = element.get('width', '').strip().lower().replace('px', '')
+        if width in ('0', '1'):
+            # Tracking image -- deleting
+            element.drop_tree()
+
+
+def has_media(tree):
+    for element in tree.iter(*MEDIA_TAGS):
+        return True
+    return False
+
+
+def detect_media(document):
+    document.has_media = has_media(document.tree)
+
+
+def extract_text(document):
+    """The text of the content, with whitespace normalized"""
+    document.text = u' '.join(document.tree.text_content().split())
+
+
+def extract_excerpt(document):
+    if document.text is None:
+        extract_text(document)
+    text = document.text
+    if len(text) > EXCERPT_LENGTH:
+        text = text[:EXCERPT_LENGTH - 1].rsplit(u' ', 1)[0] + u'…'
+    document.excerpt = text
+
+
+def sanitize(document):
+    tree = get_sanitizer().sanitize_tree(document.tree)
+    document.sanitized_content = lxml.html.tostring(tree, encoding=unicode)
+    if has_media(tree):
+        # From the sanitized tree, the content isn't sanitized again
+        strip_media(tree)
+        document.sanitized_nomedia_content = lxml.html.tostring(
+            tree, encoding=unicode)
+    else:
+        document.sanitized_nomedia_content = document.sanitized_content
+
+
+def load_stage(path):
+    module, attr = path.rsplit('.', 1)
+    try:
+        return getattr(import_module(module), attr)
+    except (ImportError, AttributeError) as e:
+        raise ImproperlyConfigured(
+            "Error loading HTML pipeline stage %s: %s" % (path, e))
+
+_stages = None
+
+
+def get_stages():
+    global _stages
+    if _stages is None:
+        paths = getattr(settings, 'HTML_PIPELINE', DEFAULT_PIPELINE)
+        _stages = [load_stage(path) for path in paths]
+    return _stages
+
+
+def process(content, stages=None):
+    """Runs ``content`` through the pipeline and returns a ``Document``"""
+    if stages is None:
+        stages = get_stages()
+    document = Document(content)
+    for stage in stages:
+        stage(document)
+    return document
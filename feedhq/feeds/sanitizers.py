@@ -0,0 +1,156 @@
+"""
+HTML sanitizers for entry content.
+
+A sanitizer enforces a whitelist of tags, attributes and CSS properties on an
+lxml tree (as produced by the HTML pipeline) and returns the sanitized HTML.
+Disallowed tags are stripped, their content is kept.
+
+The backend is selected with the ``SANITIZER`` setting, a dotted path to a
+``Sanitizer`` subclass. Defaults to ``LxmlSanitizer``, which works on the tree
+directly. ``BleachSanitizer`` serializes the tree and parses it again with
+html5lib.
+"""
+import bleach
+import copy
+import lxml.etree
+import lxml.html
+import re
+
+from bleach.sanitizer import BleachSanitizerMixin
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+MEDIA_TAGS = set(['img', 'audio', 'video'])
+
+DEFAULT_SANITIZER = 'feedhq.feeds.sanitizers.LxmlSanitizer'
+
+
+def strip_media(tree):
+    """Strips the image, audio and video tags of ``tree``, in place"""
+    for element in list(tree.iter(*MEDIA_TAGS)):
+        element.drop_tag()
+
+
+class Sanitizer(object):
+    """Base class for sanitizers. Subclasses implement ``sanitize_tree``."""
+    def __init__(self, tags, attributes, styles):
+        self.tags = set(tags)
+        self.attributes = set(attributes)
+        self.styles = set(styles)
+
+    def clean(self, html, media=True):
+        tree = lxml.html.fragment_fromstring(html or u'',
+                                             create_parent='div')
+        return self.clean_tree(tree, media=media)
+
+    def clean_tree(self, tree, media=True):
+        """
+        Returns the sanitized HTML of ``tree``, leaving ``tree`` untouched.
+        If ``media`` is false, image, audio and video tags are stripped too.
+        """
+        tree = self.sanitize_tree(tree)
+        if not media:
+            strip_media(tree)
+        return lxml.html.tostring(tree, encoding=unicode)
+
+    def sanitize_tree(self, tree):
+        """Returns a sanitized copy of ``tree``"""
+        raise NotImplementedError
+
+
+class BleachSanitizer(Sanitizer):
+    """Runs bleach (html5lib) on the serialized tree"""
+    def sanitize_tree(self, tree):
+        # The wrapping <div> is whitelisted: the output has a single root
+        return lxml.html.fragment_fromstring(bleach.clean(
+            lxml.html.tostring(tree, encoding=unicode),
+            tags=self.tags,
+            attributes=self.attributes,
+            styles=self.styles,
+            strip=True,
+        ))
+
+
+class LxmlSanitizer(Sanitizer):
+    """
+    Enforces the same rules as bleach directly on the lxml tree, without
+    re-parsing the content.
+    """
+    uri_attributes = BleachSanitizerMixin.attr_val_is_uri
+    ref_attributes = BleachSanitizerMixin.svg_attr_val_allows_ref
+    local_href_tags = BleachSanitizerMixin.svg_allow_local_href
+    protocols = BleachSanitizerMixin.allowed_protocols
+
+    uri_junk_re = re.compile(u'[`\000-\040\177-\240\\s]+')
+    scheme_re = re.compile(r'^[a-z0-9][-+.a-z0-9]*:')
+    ref_re = re.compile(r'url\s*\(\s*[^#\s][^)]+?\)')
+    local_href_re = re.compile(r'^\s*[^#\s].*')
+
+    def __init__(self, *args, **kwargs):
+        super(LxmlSanitizer, self).__init__(*args, **kwargs)
+        # Reuse bleach's CSS sanitization so that styles are handled
+        # identically by both backends.
+        self.css = BleachSanitizerMixin()
+        self.css.allowed_css_properties = self.styles
+
+    def sanitize_tree(self, tree):
+        tree = copy.deepcopy(tree)
+        for node in list(tree.iter(lxml.etree.Comment,
+                                   lxml.etree.ProcessingInstruction)):
+            node.drop_tree()
+        for element in list(tree.iter()):
+            if element is tree:
+                continue
+            if element.tag not in self.tags:
+                element.drop_tag()
+            elif element.attrib:
+                self.clean_attributes(element)
+        return tree
+
+    def clean_attributes(self, element):
+        attrib = element.attrib
+        for name in attrib.keys():
+            if name not in self.attributes:
+                del attrib[name]
+
+        for name in self.uri_attributes:
+            if name not in attrib:
+                continue
+            value = self.uri_junk_re.sub(u'', attrib[name]).lower()
+            value = value.replace(u'\ufffd', u'')
+            if (self.scheme_re.match(value) and
+                    value.split(u':')[0] not in self.protocols):
+                del attrib[name]
+
+        for name in self.ref_attributes:
+            if name in attrib:
+                attrib[name] = self.ref_re.sub(u' ', attrib[name])
+
+        if (element.tag in self.local_href_tags and
+                'xlink:href' in attrib and
+                self.local_href_re.search(attrib['xlink:href'])):
+            del attrib['xlink:href']
+
+        if 'style' in attrib:
+            attrib['style'] = self.css.sanitize_css(attrib['style'])
+
+
+_sanitizer = None
+
+
+def get_sanitizer():
+    """Returns an instance of the configured sanitizer backend"""
+    global _sanitizer
+    if _sanitizer is None:
+        from .models import UniqueEntry
+        path = getattr(settings, 'SANITIZER', DEFAULT_SANITIZER)
+        module, attr = path.rsplit('.', 1)
+        try:
+            backend = getattr(import_module(module), attr)
+        except (ImportError, AttributeError) as e:
+            raise ImproperlyConfigured(
+                "Error loading sanitizer %s: %s" % (path, e))
+        _sanitizer = backend(UniqueEntry.ELEMENTS, UniqueEntry.ATTRIBUTES,
+                             UniqueEntry.CSS_PROPERTIES)
+    return _sanitizer
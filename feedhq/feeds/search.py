@@ -0,0 +1,126 @@
+"""
+Full-text search over the entries of a user.
+
+The title and text of the entry contents are indexed when they go through the
+HTML pipeline: at ingestion time and when the ``sanitize`` command processes
+them again. Searches match all the words of the query within a user's
+entries.
+
+The backend is selected with the ``SEARCH_BACKEND`` setting, a dotted path to
+a ``SearchBackend`` subclass. Defaults to ``PostgresSearch`` on PostgreSQL and
+to ``IndexSearch`` on the other databases.
+"""
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils.importlib import import_module
+
+WORDS_RE = re.compile(r'\w+', re.UNICODE)
+# Longer words aren't indexed
+MAX_TERM_LENGTH = 50
+
+
+def get_terms(text):
+    """The distinct words of ``text``, lowercased"""
+    return set([word for word in WORDS_RE.findall(text.lower())
+                if len(word) <= MAX_TERM_LENGTH])
+
+
+def get_text(content):
+    """
+    The indexed text of a ``UniqueEntry``. The text of the content is only
+    known right after it went through the pipeline.
+    """
+    return u' '.join([content.title, getattr(content, 'text', u'')])
+
+
+class SearchBackend(object):
+    """Base class for search backends"""
+    def index(self, contents):
+        """Indexes saved ``UniqueEntry`` objects"""
+        raise NotImplementedError
+
+    def search(self, entries, query):
+        """Filters the ``entries`` queryset on their content"""
+        raise NotImplementedError
+
+
+class PostgresSearch(SearchBackend):
+    """
+    A ``tsvector`` column of the contents with a GIN index, computed by a
+    trigger when the contents are written. See
+    sql/uniqueentry.postgresql_psycopg2.sql. Titles weigh more than the text.
+    """
+    config = 'english'
+
+    def index(self, contents):
+        # Done by the trigger, in the same write as the content
+        pass
+
+    def search(self, entries, query):
+        from .models import Entry, UniqueEntry
+        # Joined to the entries of the user, the contents they don't link to
+        # are never matched. The join of select_related('content') is reused
+        # when there is one.
+        table = UniqueEntry._meta.db_table
+        return entries.extra(tables=[table], where=[
+            '{0}.id = {1}.content_id'.format(table, Entry._meta.db_table),
+            '{0}.search_vector @@ plainto_tsquery(%s::regconfig, %s)'.format(
+                table),
+        ], params=[self.config, query])
+
+
+class IndexSearch(SearchBackend):
+    """An inverted index of the words of the contents, in ``SearchTerm``"""
+    def index(self, contents):
+        from .models import SearchTerm
+        SearchTerm.objects.filter(content__in=contents).delete()
+        terms = []
+        for content in contents:
+            terms.extend([SearchTerm(term=term, content=content)
+                          for term in get_terms(get_text(content))])
+        SearchTerm.objects.bulk_create(terms)
+
+    def search(self, entries, query):
+        from .models import SearchTerm
+        terms = get_terms(query)
+        if not terms:
+            return entries.none()
+        for term in terms:
+            entries = entries.filter(content__in=SearchTerm.objects.filter(
+                term=term).values('content'))
+        return entries
+
+
+_backend = None
+
+
+def get_backend():
+    """Returns an instance of the configured search backend"""
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'SEARCH_BACKEND', None)
+        if not path:
+            if connection.vendor == 'postgresql':
+                path = 'feedhq.feeds.search.PostgresSearch'
+            else:
+                path = 'feedhq.feeds.search.IndexSearch'
+        module, attr = path.rsplit('.', 1)
+        try:
+            backend = getattr(import_module(module), attr)
+        except (ImportError, AttributeError) as e:
+            raise ImproperlyConfigured(
+                "Error loading search backend %s: %s" % (path, e))
+        _backend = backend()
+    return _backend
+
+
+def index(contents):
+    if contents:
+        get_backend().index(contents)
+
+
+def search(entries, query):
+    return get_backend().search(entries, query)
@@ -0,0 +1,8 @@
+-- Unread lists only go through the unread entries, which are a small part of
+-- the table.
+CREATE INDEX feeds_entry_user_unread ON feeds_entry (user_id, date, id)
+    WHERE NOT read;
+CREATE INDEX feeds_entry_category_unread ON feeds_entry (category_id, date, id)
+    WHERE NOT read;
+CREATE INDEX feeds_entry_feed_unread ON feeds_entry (feed_id, date, id)
+    WHERE NOT read;
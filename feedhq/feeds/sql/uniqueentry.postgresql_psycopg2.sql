@@ -0,0 +1,16 @@
+-- Full-text search on the title and text of the contents, computed when they
+-- are written. See search.PostgresSearch.
+ALTER TABLE feeds_uniqueentry ADD COLUMN search_vector tsvector;
+CREATE INDEX feeds_uniqueentry_search ON feeds_uniqueentry
+    USING gin(search_vector);
+-- Statements are split on the semicolons ending a line: the function body
+-- doesn't end any line with one. The parser skips HTML tags and entities.
+CREATE FUNCTION feeds_uniqueentry_search() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', NEW.title), 'A') ||
+        setweight(to_tsvector('english', NEW.subtitle), 'B'); RETURN NEW; END
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER feeds_uniqueentry_search BEFORE INSERT OR UPDATE OF title,
+    subtitle ON feeds_uniqueentry
+    FOR EACH ROW EXECUTE PROCEDURE feeds_uniqueentry_search();
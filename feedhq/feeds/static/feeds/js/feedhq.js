@@ -23,6 +23,67 @@
 			});
 			return this;
 		},
+		lists: function() {
+			// Paging and marking as read only replace the entry list, the
+			// server renders the list fragment for AJAX requests.
+			var ajax = window.history && history.pushState;
+
+			var update_counts = function() {
+				$.getJSON($('#entry-list').data('counts'), function(counts) {
+					$('#header .unread').text(counts.total);
+				});
+			};
+
+			var show = function(html, push) {
+				var list = $(html);
+				$('#entry-list').replaceWith(list);
+				document.title = list.data('title');
+				if (push) {
+					history.pushState({list: true}, document.title, list.data('url'));
+				}
+				if (!window.mobile) {
+					list.find('.tultip').tooltip();
+				}
+				window.scrollTo(0, 0);
+			};
+
+			$(document).on('submit', '#entry-list form.read', function() {
+				var form = $(this);
+				if (!confirm(form.data('confirm'))) {
+					return false;
+				}
+				if (!ajax) {
+					return true;
+				}
+				// Redirected to the list fragment
+				$.post(form.attr('action'), form.serialize(), function(html) {
+					show(html, true);
+					update_counts();
+				});
+				return false;
+			});
+
+			if (!ajax) {
+				return this;
+			}
+
+			$(document).on('click', '#entry-list .pagination a, #entry-list .navlist a', function() {
+				$.get($(this).attr('href'), function(html) {
+					show(html, true);
+				});
+				return false;
+			});
+
+			history.replaceState({list: true}, document.title, window.location.href);
+			$(window).on('popstate', function(e) {
+				if (e.originalEvent.state && e.originalEvent.state.list) {
+					$.get(window.location.href, function(html) {
+						show(html, false);
+					});
+				}
+			});
+			return this;
+		},
 		images: function() {
 			var timer;
 			$(document).on('scroll feedhq-loaded mousemove', function() {
@@ -0,0 +1,116 @@
+"""
+Changes to the entries of a user, kept in Redis for incremental sync.
+
+Every user has a sorted set of the entries that were added, deleted or whose
+read state changed, scored by a sequence number that grows with every change.
+Clients keep the sequence number of the last change they got, their sync
+token, and ask for the changes made after it. An entry changed several times
+is only listed once, at its last change. Whether it was deleted is known
+when the changes are listed: the entries that don't exist anymore are.
+
+Marking a whole feed or category as read moves its watermark instead of
+changing entries: the watermark itself is recorded, and clients mark their
+entries of the feed or category up to it as read.
+
+Only the ``SIZE`` most recent changes are kept. Clients with an older token,
+or a token from a log that was lost, have to sync everything again.
+"""
+import time
+
+from ..utils import get_redis_connection
+
+KEY = 'sync:%s'
+SEQUENCE_KEY = 'sync:%s:sequence'
+SIZE = 10000
+TIMEOUT = 3600 * 24 * 30
+
+
+def entry_member(pk):
+    return 'entry:%s' % pk
+
+
+def record(user_id, members):
+    """Appends changes to the log of a user"""
+    if not members:
+        return
+    key = KEY % user_id
+    sequence_key = SEQUENCE_KEY % user_id
+
+    def append(pipe):
+        # Not a small number, which is what a missing sequence would start
+        # from: tokens from a log that was lost don't match the new one.
+        # See also get_token().
+        first = int(pipe.get(sequence_key) or time.time() * 1000) + 1
+        last = first + len(members) - 1
+        args = []
+        for sequence, member in enumerate(members, first):
+            args.extend([sequence, member])
+        pipe.multi()
+        pipe.set(sequence_key, last)
+        pipe.zadd(key, *args)
+        pipe.zremrangebyscore(key, '-inf', last - SIZE)
+        pipe.expire(key, TIMEOUT)
+        pipe.expire(sequence_key, TIMEOUT)
+
+    # The sequence and the log change together, so that changes are never
+    # listed before the ones made earlier.
+    get_redis_connection().transaction(append, sequence_key)
+
+
+def add(entries):
+    """Records new entries, or entries whose read state changed"""
+    members = {}
+    for entry in entries:
+        members.setdefault(entry.user_id, []).append(entry_member(entry.pk))
+    for user_id, changes in members.items():
+        record(user_id, changes)
+
+
+def remove(rows):
+    """Records deleted entries, given as (user id, entry id) rows"""
+    members = {}
+    for user_id, pk in rows:
+        members.setdefault(user_id, []).append(entry_member(pk))
+    for user_id, changes in members.items():
+        record(user_id, changes)
+
+
+def move_watermarks(user_id, kind, pks, read_through):
+    """
+    Records the ``read_through`` watermark of the feeds or categories
+    (``kind``) with the given primary keys
+    """
+    record(user_id, ['%s:%s:%s' % (kind, pk, read_through) for pk in pks])
+
+
+def get_token(user_id):
+    """The sync token of everything recorded so far"""
+    conn = get_redis_connection()
+    key = SEQUENCE_KEY % user_id
+    value = conn.get(key)
+    if value is None:
+        conn.setnx(key, int(time.time() * 1000))
+        conn.expire(key, TIMEOUT)
+        value = conn.get(key)
+    return int(value)
+
+
+def get_changes(user_id, token, count):
+    """
+    Returns the token of everything recorded so far and up to ``count``
+    changes made after ``token``, as (token, kind, pk, read_through) tuples.
+    ``read_through`` is None for entries. Returns None when the changes since
+    ``token`` aren't known.
+    """
+    last = get_token(user_id)
+    if token > last or token < last - SIZE:
+        return None
+    members = get_redis_connection().zrangebyscore(
+        KEY % user_id, token + 1, '+inf', start=0, num=count,
+        withscores=True)
+    changes = []
+    for member, score in members:
+        bits = member.split(':')
+        read_through = int(bits[2]) if len(bits) > 2 else None
+        changes.append((int(score), bits[0], int(bits[1]), read_through))
+    return last, changes
@@ -11,6 +11,9 @@ from ..tasks import raven, enqueue
 
 logger = logging.getLogger('feedupdater')
 
+# Number of entries flagged as read per query by compact_read_state()
+COMPACT_CHUNK = 1000
+
 
 @raven
 def update_feed(feed_url, use_etags=True):
@@ -34,6 +37,45 @@ def read_later(entry_pk):
     close_connection()
 
 
+def flag_read(entries):
+    """Flags ``entries`` as read, in short updates"""
+    from .models import Entry
+    entries = entries.filter(read=False)
+    while True:
+        ids = list(entries.values_list('pk', flat=True)[:COMPACT_CHUNK])
+        if not ids:
+            break
+        Entry.objects.filter(pk__in=ids).update(read=True)
+
+
+def compact_watermark(model, pk, read_through):
+    """
+    Flags the entries below the watermark of a feed or category (``model``)
+    as read, then resets the watermark.
+    """
+    from .models import Entry
+    field = model._meta.object_name.lower()
+    flag_read(Entry.objects.filter(**{field: pk, 'pk__lte': read_through}))
+    # Unless it moved in the meantime
+    model.objects.filter(pk=pk, read_through=read_through).update(
+        read_through=0)
+
+
+@raven
+def compact_read_state(user_id):
+    """
+    Flags the entries below the read-through watermarks of a user's feeds and
+    categories as read, in short updates, then resets the watermarks.
+    """
+    from .models import Category, Feed
+    for model, lookup in [(Feed, 'category__user'), (Category, 'user')]:
+        watermarks = model.objects.filter(**{
+            lookup: user_id, 'read_through__gt': 0,
+        }).values_list('pk', 'read_through')
+        for pk, read_through in watermarks:
+            compact_watermark(model, pk, read_through)
+
+
 @raven
 def update_unique_feed(feed_url):
     from .models import UniqueFeed, Feed
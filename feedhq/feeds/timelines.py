@@ -0,0 +1,149 @@
+"""
+Timelines of entries, kept in Redis.
+
+Every user and category has two sorted sets of entry ids scored by date: all
+the entries and the unread ones. Ingestion pushes the new entries to them, so
+that lists page through the sets and load their entries by primary key
+instead of sorting the entries table.
+
+Timelines only hold the ``SIZE`` most recent entries. Pages reaching the end
+of a timeline, and pages starting at an entry that isn't in it, come from the
+database. Missing timelines are rebuilt from the database when they're read.
+Changes that move entries around (marking everything as read, moving or
+deleting feeds) just drop the timelines.
+"""
+import calendar
+
+from ..utils import get_redis_connection
+
+# Lowest member of the timelines built from the database. Entries pushed to a
+# missing timeline create an incomplete one, which is rebuilt when it's read.
+SENTINEL = 'built'
+SIZE = 1000
+TIMEOUT = 3600 * 24 * 7
+
+
+def get_key(kind, pk, unread=False):
+    """The timeline of a user or a category (``kind``)"""
+    key = 'timeline:%s:%s' % (kind, pk)
+    if unread:
+        key += ':unread'
+    return key
+
+
+def member(pk):
+    # Padded so that entries with the same date are sorted by id
+    return '%010d' % pk
+
+
+def score(date):
+    return calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6
+
+
+def entry_keys(entry, unread):
+    return [get_key('user', entry.user_id, unread),
+            get_key('category', entry.category_id, unread)]
+
+
+def add(entries):
+    """Pushes entries to their user and category timelines"""
+    if not entries:
+        return
+    pipe = get_redis_connection().pipeline()
+    keys = set()
+    for entry in entries:
+        names = entry_keys(entry, False)
+        if not entry.read:
+            names += entry_keys(entry, True)
+        for key in names:
+            pipe.zadd(key, score(entry.date), member(entry.pk))
+            keys.add(key)
+    for key in keys:
+        # Keeps the sentinel and the SIZE most recent entries
+        pipe.zremrangebyrank(key, 1, -(SIZE + 1))
+        pipe.expire(key, TIMEOUT)
+    pipe.execute()
+
+
+def mark_read(entry):
+    """Removes an entry from the unread timelines"""
+    pipe = get_redis_connection().pipeline()
+    for key in entry_keys(entry, True):
+        pipe.zrem(key, member(entry.pk))
+    pipe.execute()
+
+
+def rebuild(key, entries):
+    """
+    Fills the timeline ``key`` with the most recent ``entries``. What ``add``
+    pushed to it since the rows were read is kept.
+    """
+    rows = entries.order_by('-date', '-id').values_list('pk', 'date')[:SIZE]
+    args = ['-inf', SENTINEL]
+    for pk, date in rows:
+        args.extend([score(date), member(pk)])
+    pipe = get_redis_connection().pipeline()
+    pipe.zadd(key, *args)
+    pipe.zremrangebyrank(key, 1, -(SIZE + 1))
+    pipe.expire(key, TIMEOUT)
+    pipe.execute()
+
+
+def get_page(key, entries, before=None, after=None, nb_items=25):
+    """
+    Pages through the timeline ``key``, which holds the ``entries`` queryset.
+    Lists the entries older than the entry id ``before``, or newer than
+    ``after``.
+
+    Returns the entry ids of the page and whether there are newer entries.
+    There always are older ones. Returns None when the page has to be read
+    from the database.
+    """
+    conn = get_redis_connection()
+    pivot = before or after
+    pipe = conn.pipeline()
+    pipe.zscore(key, SENTINEL)
+    if pivot is not None:
+        pipe.zrevrank(key, member(pivot))
+    results = pipe.execute()
+    if results[0] is None:
+        rebuild(key, entries)
+        if pivot is not None:
+            results.append(conn.zrevrank(key, member(pivot)))
+
+    start = 0
+    if pivot is not None:
+        rank = results[-1]
+        if rank is None:
+            return None
+        if before is not None:
+            start = rank + 1
+        else:
+            # Less than a page of newer entries: this is the first page
+            start = max(rank - nb_items, 0)
+
+    # One more entry tells if the page reaches the end of the timeline
+    members = conn.zrevrange(key, start, start + nb_items)
+    if len(members) <= nb_items or SENTINEL in members:
+        return None
+    return [int(pk) for pk in members[:nb_items]], start > 0
+
+
+def remove(key, ids):
+    """Removes the ids of entries that aren't in a timeline anymore"""
+    if ids:
+        get_redis_connection().zrem(key, *[member(pk) for pk in ids])
+
+
+def invalidate(user_id, category_ids):
+    keys = [get_key('user', user_id), get_key('user', user_id, unread=True)]
+    for pk in category_ids:
+        keys.extend([get_key('category', pk),
+                     get_key('category', pk, unread=True)])
+    get_redis_connection().delete(*keys)
+
+
+def invalidate_unread(user_id, category_ids):
+    keys = [get_key('user', user_id, unread=True)]
+    keys.extend([get_key('category', pk, unread=True) for pk in category_ids])
+    get_redis_connection().delete(*keys)
@@ -1,17 +1,21 @@
 from django.conf.urls import url, patterns
 
-from . import views
+from . import api, views
 
 urlpatterns = patterns(
     '',
     url(r'^$', views.feed_list, name='home'),
-    url(r'^(?P<page>\d+)/$', views.feed_list, name='home'),
     url(r'^unread/$', views.feed_list,
         {'only_unread': True}, name='unread'),
-    url(r'^unread/(?P<page>\d+)/$', views.feed_list,
-        {'only_unread': True}, name='unread'),
+
+    url(r'^unread/counts/$', views.unread_counts, name='unread_counts'),
 
     url(r'^dashboard/$', views.dashboard, name='dashboard'),
+    url(r'^search/$', views.search_entries, name='search'),
+
+    # API
+    url(r'^api/sync/$', api.sync_entries, name='api_sync'),
+    url(r'^api/entries/$', api.entry_bodies, name='api_entries'),
 
     url(r'^import/$', views.import_feeds, name='import_feeds'),
     url(r'^bookmarklet/$', views.bookmarklet, name='bookmarklet'),
@@ -27,14 +31,8 @@ urlpatterns = patterns(
 
     url(r'^category/(?P<category>[\w_-]+)/$', views.feed_list,
         name='category'),
-
-    url(r'^category/(?P<category>[\w_-]+)/(?P<page>\d+)/$',
-        views.feed_list, name='category'),
-
     url(r'^category/(?P<category>[\w_-]+)/unread/$', views.feed_list,
         {'only_unread': True}, name='unread_category'),
-    url(r'^category/(?P<category>[\w_-]+)/unread/(?P<page>\d+)/$',
-        views.feed_list, {'only_unread': True}, name='unread_category'),
 
     # Feeds
     url(r'^feed/add/$', views.add_feed, name='add_feed'),
@@ -43,11 +41,8 @@ urlpatterns = patterns(
         name='delete_feed'),
 
     url(r'^feed/(?P<feed>\d+)/$', views.feed_list, name='feed'),
-    url(r'^feed/(?P<feed>\d+)/(?P<page>\d+)/$', views.feed_list, name='feed'),
     url(r'^feed/(?P<feed>\d+)/unread/$', views.feed_list,
         {'only_unread': True}, name='unread_feed'),
-    url(r'^feed/(?P<feed>\d+)/unread/(?P<page>\d+)/$', views.feed_list,
-        {'only_unread': True}, name='unread_feed'),
 
     # Entries
     url(r'^entries/(?P<entry_id>\d+)/$', views.item, name='item'),
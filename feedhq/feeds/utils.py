@@ -1,16 +1,17 @@
 # -*- coding: utf-8 -*-
 import datetime
 import logging
-import lxml.html
 import pytz
 import urlparse
 
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
 from django.utils import timezone
 
 from django_push.subscriber.models import Subscription
 
+from . import generations, search, sync, timelines
+from .duplicates import DuplicateIndex
 from .tasks import subscribe
 from ..tasks import enqueue
 from .. import __version__
@@ -26,21 +27,25 @@ logger = logging.getLogger('feedupdater')
 
 
 class FeedUpdater(object):
-    def __init__(self, parsed, feeds, hub=None):
+    def __init__(self, parsed, feeds, hub=None, unique=None):
         self.parsed = parsed
         self.feeds = feeds
         self.hub = hub
+        self.unique = unique
 
     def update(self):
         self.get_entries()
-        self.add_entries_to_feeds()
-        self.remove_old_stuff()
-        self.update_counts()
+        # Once the entries are committed, so that they're found when loading
+        # the pages of the timelines and rendering the fragments
+        entries = self.add_entries_to_feeds()
+        timelines.add(entries)
+        sync.add(entries)
+        generations.bump(*[entry.user_id for entry in entries])
         self.handle_hub()
 
     def get_entries(self):
-        """Populates self.entries: a list of Entry objects"""
-        from .models import Entry
+        """Populates self.entries: a list of UniqueEntry objects"""
+        from .models import UniqueEntry
         self.entries = []
         for entry in self.parsed.entries:
             if not 'link' in entry:
@@ -48,21 +53,8 @@ class FeedUpdater(object):
             title = entry.title if 'title' in entry else u''
             if len(title) > 255:
                 title = title[:254] + u'…'
-            parsed_entry = Entry(title=title)
-            if 'description' in entry:
-                parsed_entry.subtitle = entry.description
-            if 'summary' in entry:
-                parsed_entry.subtitle = entry.summary
-            if 'content' in entry:  # this overrides the summary
-                if entry.content:
-                    parsed_entry.subtitle = ''
-                    for content in entry.content:
-                        parsed_entry.subtitle += content.value
-
-            parsed_entry.subtitle = self.clean_content(
-                parsed_entry.subtitle,
-            )
-
+            parsed_entry = UniqueEntry(title=title,
+                                       subtitle=self.get_content(entry))
             parsed_entry.link = entry.link
             if 'guid' in entry and hasattr(self.parsed.feed, 'link'):
                 parsed_guid = urlparse.urlparse(entry.guid)
@@ -77,8 +69,24 @@ class FeedUpdater(object):
                 # Update some fields only if the entry is a new one
                 parsed_entry.date = self.get_date(entry)
 
+            # The HTML pass and the fingerprint are computed when the content
+            # is saved (see UniqueEntry.save), only for the content that isn't
+            # stored already.
             self.entries.append(parsed_entry)
 
+    @staticmethod
+    def get_content(entry):
+        """Returns the raw HTML body of a parsed entry"""
+        subtitle = u''
+        if 'description' in entry:
+            subtitle = entry.description
+        if 'summary' in entry:
+            subtitle = entry.summary
+        if 'content' in entry:  # this overrides the summary
+            if entry.content:
+                subtitle = u''.join([c.value for c in entry.content])
+        return subtitle
+
     def handle_hub(self):
         """
         Initiates a PubSubHubbub subscription and
@@ -127,83 +135,115 @@ class FeedUpdater(object):
                 entry_date = timezone.now()
         return entry_date
 
+    @staticmethod
+    def trim_overflow(entries):
+        """
+        Drops the new entries that aren't among the entries their feed keeps
+        (``Feed.get_keep_last``). They'd be deleted by the next purge and
+        added again by the next update.
+        """
+        by_feed = {}
+        for entry in entries:
+            by_feed.setdefault(entry.feed, []).append(entry)
+        dropped = set()
+        for feed, new in by_feed.items():
+            keep_last = feed.get_keep_last()
+            if keep_last is None:
+                continue
+            dates = feed.entries.order_by('-date').values_list(
+                'date', flat=True)[:keep_last]
+            # Stored entries win ties: what the purge deleted isn't added
+            # back when it has the same date as the oldest entry kept
+            rows = [(date, 1, None) for date in dates]
+            rows.extend([(entry.date, 0, entry) for entry in new])
+            rows.sort(key=lambda row: row[:2], reverse=True)
+            dropped.update([id(entry) for date, stored, entry
+                            in rows[keep_last:] if entry is not None])
+        return [entry for entry in entries if id(entry) not in dropped]
+
     @transaction.commit_on_success
     def add_entries_to_feeds(self):
-        from .models import Entry
+        from .models import Entry, UniqueEntry
+        new_entries = []
+        # Contents stored by this update, to be indexed
+        contents = []
+        # Unread count deltas, per feed
+        unread = {}
         for entry in self.entries:
+            content = UniqueEntry.objects.get_for_entry(self.unique, entry)
+
+            if not content.permalink:
+                content.permalink = entry.permalink or entry.link
+                if content.pk is not None:
+                    content.link_domain = content.get_link_domain()
+                    UniqueEntry.objects.filter(pk=content.pk).update(
+                        permalink=content.permalink,
+                        link_domain=content.link_domain,
+                    )
+
+            if not entry.link:
+                params = {'content__title__iexact': entry.title}
+            else:
+                params = {'content__link__iexact': entry.link}
+
             for feed in self.feeds:
                 if feed.muted:
                     continue
                 treshold = feed.get_treshold()
-                if treshold is not None and entry.date < treshold:
+                if treshold is not None and content.date < treshold:
                     # Skipping, it's too old
                     continue
 
-                if not entry.link:
-                    params = {'title__iexact': entry.title}
-                else:
-                    params = {'link__iexact': entry.link}
                 params['feed'] = feed
-
-                create = False
                 try:
-                    db_entry = Entry.objects.get(**params)
+                    Entry.objects.get(**params)
                 except Entry.DoesNotExist:
-                    db_entry = entry
-                    create = True
+                    new_entries.append(Entry(feed=feed, content=content,
+                                             date=content.date,
+                                             user_id=feed.category.user_id,
+                                             category_id=feed.category_id))
                 except Entry.MultipleObjectsReturned:
                     multiple = Entry.objects.filter(**params).order_by('date')
-                    db_entry = multiple[0]
                     for e in multiple[1:]:
+                        if not e.is_read:
+                            unread[feed] = unread.get(feed, 0) - 1
                         e.delete()
 
-                if db_entry.permalink:
-                    entry.permalink = db_entry.permalink
-                elif entry.permalink:
-                    db_entry.permalink = entry.permalink
-
-                if not db_entry.permalink:
-                    db_entry.permalink = entry.permalink = entry.link
-
-                db_entry.feed = feed
-                db_entry.user = feed.category.user
-                if create:
-                    db_entry.pk = None
-                    db_entry.read = False
-
-                    # If the user already has the entry, add it but as a read
-                    # entry. This is useful for people following a blog and a
-                    # planet that aggregates the same blog.
-                    if (db_entry.link and
-                        db_entry.user.entries.filter(
-                            link=db_entry.link).exists()):
-                        db_entry.read = True
-                db_entry.save()
-                feed.update_unread_count()
-
-    def clean_content(self, content):
-        page = lxml.html.fromstring('<div>%s</div>' % content)
-        for element in page.iter('img'):
-            el_str = lxml.etree.tostring(element)
-            if 'width="1"' in el_str or 'width="0"' in el_str:
-                # Tracking image -- deleting
-                element.drop_tree()
-        return lxml.etree.tostring(page)
-
-    def remove_old_stuff(self):
-        """
-        Gets rid of the `old` stuff, if the user doesn't want to keep the
-        content in the archive.
-        """
-        from .models import Entry
-        for feed in self.feeds:
-            treshold = feed.get_treshold()
-            if treshold is None:
-                continue
-
-            to_delete = Entry.objects.filter(feed=feed, date__lte=treshold)
-            to_delete.delete()
-
-    def update_counts(self):
-        for feed in self.feeds:
-            feed.update_unread_count()
+        new_entries = self.trim_overflow(new_entries)
+        if new_entries and connection.vendor == 'postgresql':
+            # One query for the ids of all the entries, see Entry.save
+            for db_entry, pk in zip(new_entries, Entry.objects.reserve_ids(
+                    len(new_entries))):
+                db_entry.pk = pk
+        for db_entry in new_entries:
+            # Content is stored once, as soon as a subscriber needs it
+            content = db_entry.content
+            if content.pk is None:
+                content.feed = self.unique
+                content.save()
+                contents.append(content)
+            db_entry.content = content
+
+        # If the user already has the entry or a near-duplicate of it, add it
+        # but as a read entry. This is useful for people following a blog and
+        # a planet that aggregates the same blog.
+        links = {}
+        for db_entry in new_entries:
+            links.setdefault(db_entry.user_id, []).append(
+                db_entry.content.link)
+        indexes = dict([(user_id, DuplicateIndex.load(user_id, user_links))
+                        for user_id, user_links in links.items()])
+        for db_entry in new_entries:
+            index = indexes[db_entry.user_id]
+            if index.contains(db_entry.content):
+                db_entry.read = True
+            index.add(db_entry.content)
+            db_entry.save(force_insert=True)
+            if not db_entry.read:
+                unread[db_entry.feed] = unread.get(db_entry.feed, 0) + 1
+        for index in indexes.values():
+            index.save()
+        for feed, count in unread.items():
+            feed.incr_unread_count(count)
+        search.index(contents)
+        return new_entries
@@ -1,152 +1,473 @@
+import datetime
+import functools
+import json
 import lxml.html
 import opml
+import pytz
 import re
 import urllib
 
 from django.contrib import messages
 from django.contrib.sites.models import RequestSite
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
-from django.core.urlresolvers import reverse, reverse_lazy
-from django.db.models import Sum
+from django.core.cache import cache
+from django.core.urlresolvers import (Resolver404, resolve, reverse,
+                                      reverse_lazy)
+from django.db.models import Max, Q
 from django.forms.formsets import formset_factory
-from django.http import HttpResponseNotAllowed
+from django.http import HttpResponse, HttpResponseNotAllowed
 from django.shortcuts import get_object_or_404, redirect, render
-from django.template.defaultfilters import slugify
+from django.template.defaultfilters import date as date_filter, slugify
+from django.utils import timezone
+from django.utils.http import urlquote
 from django.utils.translation import ugettext as _
 from django.views import generic
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
 
 from ..decorators import login_required
 from ..utils import manual_csrf_check
 from ..tasks import enqueue
-from .models import Category, Feed, Entry
+from . import (counters, generations, partitions, search, sync,
+               timelines)
+from .models import Category, Feed, Entry, unread_lookups
 from .forms import (CategoryForm, FeedForm, OPMLImportForm, ActionForm,
-                    ReadForm, SubscriptionForm)
-from .tasks import read_later
+                    ReadForm, SearchForm, SubscriptionForm)
+from .tasks import compact_read_state, compact_watermark, read_later
 
 """
 Each view displays a list of entries, with a level of filtering:
     - home: all entries
     - category: entries in a specific category
     - feed: entries for a specific feed
+    - search: entries matching a query
     - item: a single entry
 
 Entries are paginated.
 """
 
-MEDIA_RE = re.compile(r'.*<(img|audio|video)\s+.*', re.UNICODE | re.DOTALL)
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+CURSOR_RE = re.compile(r'^(-?\d+)-(\d+)$')
+# Ids are 32-bit integers in the database
+MAX_ID = 2 ** 31 - 1
 
 
-def paginate(object_list, page=1, nb_items=25, force_count=None):
+def make_cursor(entry):
+    """Position of an entry in a list: its date in microseconds, and id"""
+    delta = entry.date - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 10 ** 6
+    return '%s-%s' % (micros + delta.microseconds, entry.pk)
+
+
+def parse_cursor(value):
+    """Returns the (date, id) of a cursor, None if it's invalid"""
+    match = CURSOR_RE.match(value or '')
+    if match is None:
+        return None
+    micros, pk = map(int, match.groups())
+    if pk > MAX_ID:
+        return None
+    try:
+        return EPOCH + datetime.timedelta(microseconds=micros), pk
+    except OverflowError:
+        # Out of the range of dates
+        return None
+
+
+def paginate(entries, before=None, after=None, nb_items=25):
+    """
+    Keyset paginator for all the ``Entry`` lists, newest first.
+
+    Pages start at a (date, id) cursor instead of an offset: deep pages are as
+    cheap as the first one and don't shift when new entries come in. Lists
+    the entries older than ``before``, or newer than ``after``.
+
+    Returns the entries of the page and the cursors of the newer and older
+    pages, None when there is no such page.
     """
-    Simple generic paginator for all the ``Entry`` lists
+    if after is not None:
+        date, pk = after
+        rows = list(entries.filter(
+            Q(date__gt=date) | Q(date=date, pk__gt=pk),
+        ).order_by('date', 'pk')[:nb_items + 1])
+        if len(rows) > nb_items:
+            rows = rows[:nb_items]
+            rows.reverse()
+            return rows, make_cursor(rows[0]), make_cursor(rows[-1])
+        # Less than a page: this is the first one
+        before = None
+
+    queryset = entries.order_by('-date', '-pk')
+    if before is not None:
+        date, pk = before
+        queryset = queryset.filter(Q(date__lt=date) | Q(date=date, pk__lt=pk))
+    rows = list(queryset[:nb_items + 1])
+    if before is not None and not rows:
+        # Past the end of the list
+        return paginate(entries, nb_items=nb_items)
+
+    older = None
+    if len(rows) > nb_items:
+        rows = rows[:nb_items]
+        older = make_cursor(rows[-1])
+    newer = None
+    if before is not None:
+        newer = make_cursor(rows[0])
+    return rows, newer, older
+
+
+def within_retention(entries, categories):
     """
-    if force_count is not None:
-        object_list.count = lambda x: force_count
+    Leaves out the entries past the retention period of ``categories``, which
+    the purge deletes anyway. On PostgreSQL, the lower bound on dates lets
+    the queries skip the partitions that only hold older entries.
+    """
+    if not partitions.is_supported():
+        return entries
+    start = partitions.retention_start(categories)
+    if start is None:
+        return entries
+    return entries.filter(date__gte=start)
 
-    paginator = Paginator(object_list, nb_items)
 
-    try:
-        paginated = paginator.page(page)
-    except (EmptyPage, InvalidPage):
-        paginated = paginator.page(paginator.num_pages)
+def paginate_timeline(key, entries, before=None, after=None, nb_items=25):
+    """
+    Same as ``paginate()``, with the entry ids of the page read from the
+    timeline ``key`` in Redis. Returns None when the page has to be read from
+    the database.
+    """
+    page = timelines.get_page(key, entries,
+                              before=before and before[1],
+                              after=after and after[1],
+                              nb_items=nb_items)
+    if page is None:
+        return None
+    ids, has_newer = page
+    rows = entries.in_bulk(ids)
+    # Deleted entries, or entries read since they were added to the timeline
+    timelines.remove(key, [pk for pk in ids if pk not in rows])
+    rows = [rows[pk] for pk in ids if pk in rows]
+    if not rows:
+        return None
+    newer = make_cursor(rows[0]) if has_newer else None
+    return rows, newer, make_cursor(rows[-1])
+
+
+# The columns entry lists are built from. Entry bodies are only loaded when
+# an entry is read. The user and category are set on the entries of related
+# managers (user.entries, category.entries).
+LIST_FIELDS = (
+    'date', 'read', 'user', 'category', 'feed', 'content',
+    'feed__name', 'feed__favicon', 'feed__read_through', 'feed__category',
+    'feed__category__color', 'feed__category__read_through',
+    'content__sanitized_title',
+)
+
+
+NAVIGATION_KEY = 'navigation:%s'
+NAVIGATION_TIMEOUT = 3600 * 24
+# A neighbour that isn't on the cached page
+UNKNOWN = object()
+
+
+def save_navigation(user, url, entries, newer, older):
+    """
+    Caches the ids of the entries on the list page the user is reading, for
+    the previous / next links of the entries.
+    """
+    ids = [entry.pk for entry in entries]
+    cache.set(NAVIGATION_KEY % user.pk, {
+        'url': url,
+        'ids': ids,
+        'positions': dict(zip(ids, range(len(ids)))),
+        'newer': newer is not None,
+        'older': older is not None,
+    }, NAVIGATION_TIMEOUT)
 
-    return paginated, paginator._count
+
+def get_neighbours(user, url, pk):
+    """
+    Returns the ids of the newer and older entries around ``pk`` on the list
+    page at ``url``. Neighbours that can't be found in the cached page are
+    ``UNKNOWN``, None means there is no such entry.
+    """
+    window = cache.get(NAVIGATION_KEY % user.pk)
+    if window is None or window['url'] != url:
+        return UNKNOWN, UNKNOWN
+    position = window['positions'].get(pk)
+    if position is None:
+        return UNKNOWN, UNKNOWN
+    ids = window['ids']
+
+    if position > 0:
+        newer = ids[position - 1]
+    else:
+        newer = UNKNOWN if window['newer'] else None
+    if position < len(ids) - 1:
+        older = ids[position + 1]
+    else:
+        older = UNKNOWN if window['older'] else None
+    return newer, older
+
+
+def get_rows(entries, user, only_unread, list_url):
+    """
+    Prepares what the entry lists display as plain dicts, in one pass. The
+    feeds' URLs and favicons are computed once per feed instead of once per
+    row.
+    """
+    tz = pytz.timezone(user.timezone)
+    back = '?back=%s' % urlquote(list_url, safe='')
+    feed_view = 'feeds:unread_feed' if only_unread else 'feeds:feed'
+    no_title = _('(No title)')
+    feeds = {}
+    rows = []
+    for entry in entries:
+        feed = feeds.get(entry.feed_id)
+        if feed is None:
+            feed = feeds[entry.feed_id] = {
+                'name': entry.feed.name,
+                'url': reverse(feed_view, args=[entry.feed_id]),
+                'color': entry.feed.category.color,
+                'favicon': entry.feed.favicon and entry.feed.favicon.url,
+            }
+        rows.append({
+            'new': not entry.is_read,
+            'url': reverse('feeds:item', args=[entry.pk]) + back,
+            'title': entry.content.sanitized_title or no_title,
+            'date': date_filter(timezone.localtime(entry.date, tz)),
+            'feed': feed,
+        })
+    return rows
+
+
+# The lists an entry can be read from
+LIST_VIEWS = ('home', 'unread', 'category', 'unread_category', 'feed',
+              'unread_feed', 'search')
+
+
+def get_back_url(request, entry):
+    """
+    The list an entry is read from, passed in the ``back`` parameter of its
+    URL. Defaults to the entry's feed, only entry lists are accepted.
+    """
+    back_url = request.GET.get('back', '')
+    if back_url.startswith('/') and not back_url.startswith('//'):
+        try:
+            match = resolve(back_url.split('?')[0])
+        except Resolver404:
+            match = None
+        if (match is not None and match.namespace == 'feeds' and
+                match.url_name in LIST_VIEWS):
+            return back_url
+    return entry.feed.get_absolute_url()
 
 
 @login_required
-def feed_list(request, page=1, only_unread=False, category=None, feed=None):
+@vary_on_headers('X-Requested-With')
+@condition(etag_func=generations.etag)
+def feed_list(request, only_unread=False, category=None, feed=None):
     """
     Displays a paginated list of entries.
 
-    ``page``: the page number
     ``only_unread``: filters the list to display only the new entries
     ``category``: (slug) if set, will filter the entries of this category
     ``feed``: (object_id) if set, will filter the entries of this feed
 
     Note: only set category OR feed. Not both at the same time.
+
+    The ``before`` and ``after`` GET parameters are the pagination cursors.
+    The total number of entries is only counted with ``?total=1``.
+
+    AJAX requests only get the list fragment, without the rest of the page.
     """
     user = request.user
-    # Filtering the categories only to those owned by this user
-    categories = user.categories.with_unread_counts()
+    # Read before anything it's bumped for: fragments rendered with stale
+    # data are cached for the previous generation.
+    generations.get_request_generation(request)
+    counts = counters.get_request_counts(request)
+    unread_count = counts.total
 
     if category is not None:
         category = get_object_or_404(user.categories.all(), slug=category)
-        entries = user.entries.filter(feed__category=category)
+        entries = user.entries.filter(category=category)
         all_url = reverse('feeds:category', args=[category.slug])
         unread_url = reverse('feeds:unread_category', args=[category.slug])
+        unread_count = counts.category(category.pk)
 
     if feed is not None:
-        cat_ids = [c['id'] for c in categories]
         feed = get_object_or_404(Feed.objects.select_related('category'),
-                                 category__in=cat_ids, pk=feed)
+                                 category__user=user, pk=feed)
         entries = feed.entries.all()
         all_url = reverse('feeds:feed', args=[feed.id])
         unread_url = reverse('feeds:unread_feed', args=[feed.id])
         category = feed.category
+        unread_count = counts.feed(feed.pk)
 
     if feed is None and category is None:
         entries = user.entries.all()
         all_url = reverse('feeds:home')
         unread_url = reverse('feeds:unread')
 
-    entries = entries.select_related('feed', 'feed__category')
+    entries = entries.select_related(
+        'feed', 'feed__category', 'content',
+    ).only(*LIST_FIELDS)
 
     if request.method == "POST":
         form = ReadForm(data=request.POST)
         if form.is_valid():
-            count = entries.filter(read=False).count()
-            entries.update(read=True)
+            # Everything that's already there is read: only the read-through
+            # watermark is moved, the entries are flagged in the background.
+            # The newest of the listed entries: newer ids of the whole table
+            # may belong to entries being added to this list, which the user
+            # hasn't seen.
+            read_through = entries.aggregate(
+                read_through=Max('id'))['read_through'] or 0
             if feed is not None:
+                watermarks = Feed.objects.filter(pk=feed.pk)
                 feeds = Feed.objects.filter(pk=feed.pk)
             elif category is not None:
+                watermarks = Category.objects.filter(pk=category.pk)
                 feeds = category.feeds.all()
             else:
+                watermarks = user.categories.all()
                 feeds = Feed.objects.filter(category__user=user)
+            watermarks.filter(read_through__lt=read_through).update(
+                read_through=read_through)
+            sync.move_watermarks(
+                user.pk, 'feed' if feed is not None else 'category',
+                watermarks.values_list('pk', flat=True), read_through)
             feeds.update(unread_count=0)
-            messages.success(request,
-                             _('%s entries have been marked as read' % count))
+            counters.invalidate(user.pk)
+            timelines.invalidate_unread(user.pk, set(
+                feeds.values_list('category', flat=True)))
+            generations.bump(user.pk)
+            enqueue(compact_read_state, args=[user.pk], timeout=600)
+            if not request.is_ajax():
+                # Not shown by the list fragment
+                messages.success(request, _('%s entries have been marked as '
+                                            'read' % unread_count))
             return redirect(all_url)
 
-    unread_count = entries.filter(read=False).count()
+    if category is not None:
+        entries = within_retention(entries, [category])
+    else:
+        entries = within_retention(entries, user.categories.all())
+
+    total_count = None
+    if request.GET.get('total'):
+        total_count = entries.count()
 
-    # base_url is a variable that helps the paginator a lot. The drawback is
-    # that the paginator can't use reversed URLs.
     base_url = all_url
     if only_unread:
-        total_count = entries.count()
-        entries = entries.filter(read=False)
+        entries = entries.filter(**unread_lookups())
         base_url = unread_url
-        entries, foo = paginate(entries, page=page,
-                                force_count=unread_count,
-                                nb_items=request.user.entries_per_page)
-    else:
-        entries, total_count = paginate(entries, page=page,
-                                        nb_items=request.user.entries_per_page)
-
-    request.session['back_url'] = request.get_full_path()
+    pagination = {
+        'before': parse_cursor(request.GET.get('before')),
+        'after': parse_cursor(request.GET.get('after')),
+        'nb_items': request.user.entries_per_page,
+    }
+    page = None
+    if feed is None:
+        # Feed lists are cheap enough to read from the database
+        if category is not None:
+            key = timelines.get_key('category', category.pk, only_unread)
+        else:
+            key = timelines.get_key('user', user.pk, only_unread)
+        page = paginate_timeline(key, entries, **pagination)
+    if page is None:
+        page = paginate(entries, **pagination)
+    entries, newer, older = page
+
+    # Entries link back to this page, the session isn't written
+    list_url = request.get_full_path()
+    save_navigation(user, list_url, entries, newer, older)
     context = {
-        'categories': categories,
         'category': category,
         'feed': feed,
         'entries': entries,
+        # Only prepared when the list isn't cached
+        'rows': functools.partial(get_rows, entries, user, only_unread,
+                                  list_url),
         'only_unread': only_unread,
         'unread_count': unread_count,
         'total_count': total_count,
         'all_url': all_url,
         'unread_url': unread_url,
-        'base_url': base_url,
+        'newer_url': None,
+        'older_url': None,
     }
+    if newer is not None:
+        context['newer_url'] = '%s?after=%s' % (base_url, newer)
+    if older is not None:
+        context['older_url'] = '%s?before=%s' % (base_url, older)
     if unread_count:
         context['form'] = ReadForm()
         context['action'] = request.get_full_path()
-    if entries.paginator.count == 0 and Feed.objects.filter(
-        category__in=request.user.categories.all()
-    ).count() == 0:
+    if request.is_ajax():
+        # Paging and marking as read only replace the list, see feedhq.js
+        return render(request, 'feeds/entry_list.html', context)
+    if not entries and newer is None and not Feed.objects.filter(
+        category__user=user,
+    ).exists():
         context['noob'] = True
     return render(request, 'feeds/feed_list.html', context)
 
 
+@login_required
+def search_entries(request):
+    """
+    Displays the entries matching the ``q`` GET parameter, paginated like the
+    other lists.
+    """
+    form = SearchForm(data=request.GET or None)
+    context = {
+        'form': form,
+        'query': None,
+        'newer_url': None,
+        'older_url': None,
+    }
+    if form.is_valid():
+        query = form.cleaned_data['q']
+        entries = within_retention(request.user.entries.select_related(
+            'feed', 'feed__category', 'content',
+        ).only(*LIST_FIELDS), request.user.categories.all())
+        entries = search.search(entries, query)
+        entries, newer, older = paginate(
+            entries,
+            before=parse_cursor(request.GET.get('before')),
+            after=parse_cursor(request.GET.get('after')),
+            nb_items=request.user.entries_per_page,
+        )
+        base_url = '%s?%s' % (reverse('feeds:search'), urllib.urlencode({
+            'q': query.encode('utf-8'),
+        }))
+        context.update({
+            'query': query,
+            'entries': entries,
+            'rows': functools.partial(get_rows, entries, request.user, False,
+                                      request.get_full_path()),
+        })
+        if newer is not None:
+            context['newer_url'] = '%s&after=%s' % (base_url, newer)
+        if older is not None:
+            context['older_url'] = '%s&before=%s' % (base_url, older)
+    return render(request, 'feeds/search.html', context)
+
+
+@login_required
+@condition(etag_func=generations.etag)
+def unread_counts(request):
+    """The unread counts of the user's feeds and categories, as JSON"""
+    counts = counters.get_request_counts(request)
+    data = {
+        'total': counts.total,
+        'categories': counts.categories,
+        'feeds': counts.feeds,
+    }
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
 @login_required
 def add_category(request):
     """Add a category"""
@@ -160,6 +481,7 @@ def add_category(request):
                 user=request.user,
                 color=form.cleaned_data['color'],
                 delete_after=form.cleaned_data['delete_after'],
+                keep_last=form.cleaned_data['keep_last'],
             )
             category.save()
             return redirect(reverse('feeds:category', args=[category.slug]))
@@ -180,7 +502,8 @@ def edit_category(request, slug):
         form = CategoryForm(data=request.POST, instance=category)
         form.user = request.user
         if form.is_valid():
-            form.save()
+            # Counters and watermarks are updated concurrently
+            form.save(commit=False).save(update_fields=form.fields.keys())
             messages.success(request, _('%(category)s has been successfully '
                                         'updated') % {'category': category})
 
@@ -203,9 +526,7 @@ class DeleteCategory(generic.DeleteView):
 
     def get_context_data(self, **kwargs):
         kwargs.update({
-            'entry_count': Entry.objects.filter(
-                feed__category=self.object,
-            ).count(),
+            'entry_count': self.object.entries.count(),
             'feed_count': self.object.feeds.count(),
         })
         return super(DeleteCategory, self).get_context_data(**kwargs)
@@ -249,7 +570,9 @@ def edit_feed(request, feed):
         )
 
         if form.is_valid():
-            instance = form.save()
+            # Counters and watermarks are updated concurrently
+            instance = form.save(commit=False)
+            instance.save(update_fields=form.fields.keys())
             messages.success(request, _('%(feed)s has been successfully '
                                         'updated') % {'feed': feed})
             return redirect(reverse('feeds:feed', args=[instance.pk]))
@@ -284,15 +607,17 @@ delete_feed = login_required(DeleteFeed.as_view())
 @login_required
 def item(request, entry_id):
     qs = Entry.objects.filter(user=request.user).select_related(
-        'feed', 'feed__category',
+        'feed', 'feed__category', 'content',
     )
     entry = get_object_or_404(qs, pk=entry_id)
-    if not entry.read:
-        Entry.objects.filter(pk=entry.pk).update(read=True)
-        entry.feed.update_unread_count()
+    if not entry.is_read:
+        if Entry.objects.filter(pk=entry.pk, read=False).update(read=True):
+            entry.read = True
+            entry.feed.incr_unread_count(-1)
+            timelines.mark_read(entry)
+            sync.add([entry])
 
-    back_url = request.session.get('back_url',
-                                   default=entry.feed.get_absolute_url())
+    back_url = get_back_url(request, entry)
 
     # Depending on the list used to access to this page, we try to find in an
     # intelligent way which is the previous and the next item in the list.
@@ -301,7 +626,6 @@ def item(request, entry_id):
     # dynamically changed
     only_unread = False
     bits = back_url.split('/')
-    # FIXME: The kw thing currently doesn't work with paginated content.
     kw = {'user': request.user}
 
     if bits[1] == '':
@@ -310,7 +634,8 @@ def item(request, entry_id):
 
     elif bits[1] == 'unread':
         # Homepage too, but only unread
-        kw = {'user': request.user, 'read': False}
+        kw = {'user': request.user}
+        kw.update(unread_lookups())
         only_unread = True
 
     elif bits[1] == 'feed':
@@ -319,23 +644,31 @@ def item(request, entry_id):
 
     elif bits[1] == 'category':
         # Entries in self.feed.category
-        category_slug = bits[2]
-        category = Category.objects.get(slug=category_slug, user=request.user)
-        kw = {'feed__category': category}
+        kw = {'user': request.user, 'category__slug': bits[2]}
 
     if len(bits) > 3 and bits[3] == 'unread':
-        kw['read'] = False
+        kw.update(unread_lookups())
         only_unread = True
 
-    # The previous is actually the next by date, and vice versa
-    try:
-        previous = entry.get_next_by_date(**kw).get_absolute_url()
-    except entry.DoesNotExist:
-        previous = None
-    try:
-        next = entry.get_previous_by_date(**kw).get_absolute_url()
-    except entry.DoesNotExist:
-        next = None
+    # The previous is actually the next by date, and vice versa. They're
+    # looked up on the list page the user comes from, and only queried when
+    # they're on another page.
+    previous, next = get_neighbours(request.user, back_url, entry.pk)
+    if previous is UNKNOWN:
+        try:
+            previous = entry.get_next_by_date(**kw).pk
+        except entry.DoesNotExist:
+            previous = None
+    if next is UNKNOWN:
+        try:
+            next = entry.get_previous_by_date(**kw).pk
+        except entry.DoesNotExist:
+            next = None
+    back = '?back=%s' % urlquote(back_url, safe='')
+    if previous is not None:
+        previous = reverse('feeds:item', args=[previous]) + back
+    if next is not None:
+        next = reverse('feeds:item', args=[next]) + back
 
     # For serch results, previous and next aren't available
     if bits[1] == 'search':
@@ -344,9 +677,8 @@ def item(request, entry_id):
 
     # if there is an image in the entry, don't show it. We need user
     # intervention to display the image.
-    has_media = media_safe = False
-    if MEDIA_RE.match(entry.subtitle):
-        has_media = True
+    has_media = entry.content.has_media
+    media_safe = False
 
     if request.method == 'POST':
         form = ActionForm(data=request.POST)
@@ -364,8 +696,19 @@ def item(request, entry_id):
                     Feed.objects.filter(pk=entry.feed.pk).update(img_safe=True)
                     entry.feed.img_safe = True
             elif action == 'unread':
-                Entry.objects.filter(pk=entry.pk).update(read=False)
-                entry.feed.update_unread_count()
+                # Read because of a watermark, which goes away once the
+                # entries below it are flagged as read. Only the watermarks
+                # covering this entry are compacted here.
+                for model, obj in [(Feed, entry.feed),
+                                   (Category, entry.feed.category)]:
+                    if entry.pk <= obj.read_through:
+                        compact_watermark(model, obj.pk, obj.read_through)
+                if Entry.objects.filter(pk=entry.pk,
+                                        read=True).update(read=False):
+                    entry.feed.incr_unread_count()
+                    entry.read = False
+                    timelines.add([entry])
+                    sync.add([entry])
                 return redirect(back_url)
             elif action == 'read_later':
                 enqueue(read_later, args=[entry.pk], timeout=20, queue='high')
@@ -376,7 +719,6 @@ def item(request, entry_id):
 
     context = {
         'category': entry.feed.category,
-        'categories': request.user.categories.with_unread_counts(),
         'back_url': back_url,
         'only_unread': only_unread,
         'previous': previous,
@@ -460,27 +802,41 @@ def import_feeds(request):
 
 
 @login_required
+@condition(etag_func=generations.etag)
 def dashboard(request):
-    categories = Category.objects.prefetch_related(
-        'feeds',
-    ).filter(user=request.user).annotate(
-        unread_count=Sum('feeds__unread_count'),
-    )
+    # Read before the categories, see feed_list()
+    generations.get_request_generation(request)
+
+    def columns():
+        """Categories in 3 columns, only loaded if the page isn't cached"""
+        categories = Category.objects.prefetch_related(
+            'feeds',
+        ).filter(user=request.user)
+        counts = counters.get_request_counts(request)
+        for category in categories:
+            category.unread_count = counts.category(category.pk)
+
+        total = sum((len(c.feeds.all()) for c in categories))
+        col_size = total / 3
+        col_1 = None
+        col_2 = None
+        done = 0
+        for index, cat in enumerate(categories):
+            done += len(cat.feeds.all())
+            if col_1 is None and done > col_size:
+                col_1 = index + 1
+            if col_2 is None and done > 2 * col_size:
+                col_2 = index + 1
+
+        columns = [[]]
+        for index, cat in enumerate(categories):
+            columns[-1].append(cat)
+            if index + 1 in (col_1, col_2):
+                columns.append([])
+        return columns
 
-    total = sum((len(c.feeds.all()) for c in categories))
-    col_size = total / 3
-    col_1 = None
-    col_2 = None
-    done = 0
-    for index, cat in enumerate(categories):
-        done += len(cat.feeds.all())
-        if col_1 is None and done > col_size:
-            col_1 = index + 1
-        if col_2 is None and done > 2 * col_size:
-            col_2 = index + 1
     context = {
-        'categories': categories,
-        'breaks': [col_1, col_2],
+        'columns': columns,
     }
     return render(request, 'feeds/dashboard.html', context)
 
@@ -3,12 +3,14 @@ from django.core.urlresolvers import reverse, reverse_lazy
 from django.shortcuts import redirect, render
 from django.utils.translation import ugettext as _
 from django.views import generic
+from django.views.decorators.http import condition
 
 from password_reset import views
 
 from .forms import (ChangePasswordForm, ProfileForm, CredentialsForm,
                     ServiceForm, DeleteAccountForm)
 from ..decorators import login_required
+from ..feeds import generations
 from ..feeds.models import Feed
 
 
@@ -63,6 +65,7 @@ profile = login_required(ProfileView.as_view())
 
 
 @login_required
+@condition(etag_func=generations.etag)
 def export(request):
     """OPML export"""
     response = render(request, 'profiles/opml_export.opml',
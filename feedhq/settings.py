@@ -73,6 +73,8 @@ TEMPLATE_CONTEXT_PROCESSORS = (
     'django.core.context_processors.request',
     'django.contrib.messages.context_processors.messages',
     'sekizai.context_processors.sekizai',
+    'feedhq.feeds.context_processors.unread_counts',
+    'feedhq.feeds.context_processors.fragments',
 )
 
 parsed_redis = urlparse.urlparse(os.environ['REDIS_URL'])
@@ -91,6 +93,13 @@ RQ = {
     'eager': bool(urlparse.parse_qs(querystring).get('eager', False)),
 }
 
+REDIS = {
+    'host': parsed_redis.hostname,
+    'port': parsed_redis.port or 6379,
+    'password': parsed_redis.password,
+    'db': int(path[1:]),
+}
+
 
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
@@ -102,6 +111,12 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+SANITIZER = os.environ.get('SANITIZER',
+                           'feedhq.feeds.sanitizers.LxmlSanitizer')
+
+# Defaults to the full-text search of the database, when it has one
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+
 if 'SENTRY_DSN' in os.environ:
     MIDDLEWARE_CLASSES = MIDDLEWARE_CLASSES + (
         'raven.contrib.django.middleware.Sentry404CatchMiddleware',
@@ -1,3 +1,5 @@
+import redis
+
 from django.conf import settings
 from django.middleware.csrf import (
     CsrfViewMiddleware, REASON_NO_CSRF_COOKIE, REASON_NO_REFERER,
@@ -8,6 +10,16 @@ from django.utils.http import same_origin
 
 middleware = CsrfViewMiddleware()
 
+_redis = None
+
+
+def get_redis_connection():
+    """Returns the connection to the Redis server set in ``settings.REDIS``"""
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis(**settings.REDIS)
+    return _redis
+
 
 def manual_csrf_check(request):
     """
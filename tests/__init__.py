@@ -1,5 +1,6 @@
 import warnings
 
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.client import Client as BaseClient
 
@@ -14,3 +15,7 @@ class Client(BaseClient):
 
 class FeedHQTestCase(TestCase):
     client_class = Client
+
+    def setUp(self):
+        super(FeedHQTestCase, self).setUp()
+        cache.clear()
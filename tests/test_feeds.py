@@ -1,23 +1,41 @@
 # -*- coding: utf-8 -*-
+import datetime
 import feedparser
 import json
+import lxml.html
 import os
+import urlparse
 
+from contextlib import contextmanager
 from StringIO import StringIO
 
 from django_push.subscriber.signals import updated
 from httplib2 import Response
 from mock import patch
 from requests import Response as _Response
+from ratelimitbackend import admin
 from rq.timeouts import JobTimeoutException
 
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.template import Context, Template
+from django.test.client import RequestFactory
 from django.contrib.auth.models import User
 from django.utils import timezone
-
-from feedhq.feeds.models import Category, Feed, Entry, Favicon, UniqueFeed
-from feedhq.feeds.tasks import update_feed
-from feedhq.feeds.utils import FAVICON_FETCHER, USER_AGENT
+from django.utils.http import urlquote
+from django.utils.unittest import skipUnless
+
+from feedhq.feeds import (counters, duplicates, generations, partitions,
+                          pipeline, sanitizers, search, timelines)
+from feedhq.feeds.sanitizers import BleachSanitizer, LxmlSanitizer
+from feedhq.feeds.models import (Category, Feed, Entry, Favicon, SearchTerm,
+                                 UniqueFeed, UniqueEntry)
+from feedhq.feeds.tasks import compact_read_state, update_feed
+from feedhq.feeds.utils import FAVICON_FETCHER, USER_AGENT, FeedUpdater
+from feedhq.utils import get_redis_connection
 
 from . import FeedHQTestCase as TestCase
 
@@ -45,6 +63,19 @@ def responses(code, path=None, redirection=None,
     return response
 
 
+@contextmanager
+def capture_queries():
+    """Collects the SQL of the queries run in the block"""
+    queries = []
+    connection.use_debug_cursor = True
+    connection.queries = []
+    try:
+        yield queries
+    finally:
+        connection.use_debug_cursor = False
+        queries.extend([query['sql'] for query in connection.queries])
+
+
 class BaseTests(TestCase):
     """Tests that do not require specific setup"""
     @patch('requests.get')
@@ -81,6 +112,7 @@ class TestFeeds(TestCase):
     def setUp(self, get):
         """Main stuff we need for testing the app - this is mainly for signed
         in users."""
+        super(TestFeeds, self).setUp()
         # We'll need a user...
         self.user = User.objects.create_user('testuser',
                                              'foo@example.com',
@@ -142,23 +174,54 @@ class TestFeeds(TestCase):
 
         feed = Feed.objects.get(pk=feed.id)
         self.assertEqual(feed.entries.count(), 1)
-        self.assertEqual(feed.entries.all()[0].title, 'First item title')
+        self.assertEqual(feed.entries.all()[0].content.title,
+                         'First item title')
 
     @patch('requests.get')
     def test_entry_model(self, get):
         get.return_value = responses(200, self.feed.url)
         update_feed(self.feed.url, use_etags=False)
         title = 'RE2: a principled approach to regular expression matching'
-        entry = Entry.objects.get(title=title)
+        entry = Entry.objects.get(content__title=title)
 
         # __unicode__
         self.assertEqual('%s' % entry, title)
 
         # get_link()
-        self.assertEqual(entry.get_link(), entry.link)
+        content = entry.content
+        self.assertEqual(content.get_link(), content.link)
         # Setting permalink
-        entry.permalink = 'http://example.com/some-url'
-        self.assertEqual(entry.get_link(), entry.permalink)
+        content.permalink = 'http://example.com/some-url'
+        self.assertEqual(content.get_link(), content.permalink)
+
+    @patch('requests.get')
+    def test_shared_content(self, get):
+        """Subscribers to the same feed share the entries' content"""
+        get.return_value = responses(304)
+        user = User.objects.create_user('other', 'other@example.com', 'pass')
+        cat = Category.objects.create(name='Other', slug='other', user=user,
+                                      delete_after='never')
+        cat.feeds.create(name='Same Feed', url=self.feed.url)
+
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        self.assertEqual(UniqueEntry.objects.count(), 30)
+        self.assertEqual(Entry.objects.count(), 60)
+        self.assertEqual(user.entries.count(), 30)
+        self.assertEqual(self.user.entries.count(), 30)
+
+        # Updating again doesn't duplicate anything
+        update_feed(self.feed.url, use_etags=False)
+        self.assertEqual(UniqueEntry.objects.count(), 30)
+        self.assertEqual(Entry.objects.count(), 60)
+
+        # Entry lists don't query the content of each row, unread counts
+        # come from Redis and the session isn't written. On PostgreSQL, the
+        # categories bound the dates of the entries (see within_retention).
+        url = reverse('feeds:home')
+        self.client.get(url)
+        with self.assertNumQueries(4 if partitions.is_supported() else 3):
+            self.client.get(url)
 
     @patch('requests.get')
     def test_ctype(self, get):
@@ -209,9 +272,263 @@ class TestFeeds(TestCase):
         get.return_value = responses(200, 'atom10.xml')
         self.cat.feeds.create(name='Content', url='atom10.xml')
         entry = Entry.objects.get()
-        self.assertEqual(entry.sanitized_content(),
+        self.assertEqual(entry.content.sanitized_content,
+                         "<div>Watch out for <span> nasty tricks</span></div>")
+
+    @patch('requests.get')
+    def test_sanitize_at_ingestion(self, get):
+        get.return_value = responses(200, 'atom10.xml')
+        self.cat.feeds.create(name='Content', url='atom10.xml')
+        content = UniqueEntry.objects.get()
+        self.assertEqual(content.sanitizer_version,
+                         UniqueEntry.SANITIZER_VERSION)
+        self.assertEqual(content.link_domain, 'example.org')
+        self.assertFalse(content.has_media)
+
+        # Stored content isn't processed again by the next updates
+        with patch('feedhq.feeds.pipeline.process') as process:
+            update_feed('atom10.xml', use_etags=False)
+        self.assertFalse(process.called)
+
+        # Outdated content gets regenerated by the backfill command
+        UniqueEntry.objects.update(sanitizer_version=0, sanitized_content='',
+                                   link_domain='')
+        call_command('sanitize', stdout=StringIO())
+        content = UniqueEntry.objects.get()
+        self.assertEqual(content.sanitizer_version,
+                         UniqueEntry.SANITIZER_VERSION)
+        self.assertEqual(content.link_domain, 'example.org')
+        self.assertEqual(content.sanitized_content,
                          "<div>Watch out for <span> nasty tricks</span></div>")
 
+    @patch('requests.get')
+    def test_purge(self, get):
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+
+        user = User.objects.create_user('other', 'other@example.com', 'pass')
+        category = user.categories.create(name='Cat', slug='cat',
+                                          delete_after='never')
+        feed = category.feeds.create(name='Same', url=self.feed.url)
+        self.assertEqual(UniqueEntry.objects.count(), 30)
+
+        # Entries are from 2009, way past a year
+        self.cat.delete_after = '1year'
+        self.cat.save()
+        stdout = StringIO()
+        call_command('purge', chunk=7, stdout=stdout)
+        self.assertTrue(stdout.getvalue().startswith(
+            '30 entries and 0 orphaned contents purged'))
+        self.assertEqual(self.user.entries.count(), 0)
+        self.assertEqual(Feed.objects.get(pk=self.feed.pk).unread_count, 0)
+        self.assertEqual(user.entries.count(), 30)
+        self.assertEqual(Feed.objects.get(pk=feed.pk).unread_count, 30)
+
+        # Content goes away with the last subscriber
+        feed.delete()
+        call_command('purge', stdout=stdout)
+        self.assertEqual(UniqueEntry.objects.count(), 0)
+
+    @patch('requests.get')
+    def test_purge_keep_last(self, get):
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        newest = list(self.feed.entries.order_by('-date', '-pk')[:10])
+
+        self.cat.keep_last = 10
+        self.cat.save()
+        call_command('purge', chunk=7, stdout=StringIO())
+        self.assertEqual(list(self.feed.entries.order_by('-date', '-pk')),
+                         newest)
+        self.assertEqual(Feed.objects.get(pk=self.feed.pk).unread_count, 10)
+
+        # Feeds can override the category setting
+        Feed.objects.filter(pk=self.feed.pk).update(keep_last=3)
+        call_command('purge', stdout=StringIO())
+        self.assertEqual(list(self.feed.entries.order_by('-date', '-pk')),
+                         newest[:3])
+
+        # Updates don't add back what the purge deleted
+        update_feed(self.feed.url, use_etags=False)
+        self.assertEqual(list(self.feed.entries.order_by('-date', '-pk')),
+                         newest[:3])
+        self.assertEqual(Feed.objects.get(pk=self.feed.pk).unread_count, 3)
+
+        # Nor more entries than the feed keeps
+        feed = self.cat.feeds.create(name='Other', url='atom10.xml',
+                                     keep_last=1)
+        self.assertEqual(feed.entries.count(), 1)
+        self.assertEqual(UniqueEntry.objects.filter(
+            subscriptions__isnull=True).count(), 0)
+
+    @skipUnless(partitions.is_supported(), "Requires PostgreSQL")
+    @patch('requests.get')
+    def test_upgrade(self, get):
+        """Existing installs get the content of their entries moved"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        user = User.objects.create_user('other', 'other@example.com', 'pass')
+        category = user.categories.create(name='Cat', slug='cat')
+        category.feeds.create(name='Same', url=self.feed.url)
+        expected = sorted(Entry.objects.values_list(
+            'pk', 'content__title', 'content__link', 'category'))
+
+        # The schema the entries had before sharing their content
+        cursor = connection.cursor()
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        cursor.execute("""
+            ALTER TABLE feeds_entry
+            ADD COLUMN title varchar(255) NOT NULL DEFAULT '',
+            ADD COLUMN subtitle text NOT NULL DEFAULT '',
+            ADD COLUMN link varchar(1023) NOT NULL DEFAULT '',
+            ADD COLUMN permalink varchar(1023) NOT NULL DEFAULT '';
+            UPDATE feeds_entry entry SET title = content.title,
+                subtitle = content.subtitle, link = content.link,
+                permalink = content.permalink
+            FROM feeds_uniqueentry content
+            WHERE content.id = entry.content_id;
+            ALTER TABLE feeds_entry DROP COLUMN content_id,
+                DROP COLUMN category_id;
+            ALTER TABLE feeds_feed DROP COLUMN keep_last,
+                DROP COLUMN read_through;
+            ALTER TABLE feeds_category DROP COLUMN keep_last,
+                DROP COLUMN read_through;
+            DELETE FROM feeds_uniqueentry;
+        """)
+
+        call_command('upgrade', stdout=StringIO())
+        self.assertEqual(UniqueEntry.objects.count(), 30)
+        self.assertEqual(sorted(Entry.objects.values_list(
+            'pk', 'content__title', 'content__link', 'category')), expected)
+        self.assertEqual(self.feed.entries.unread().count(), 30)
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                       ['feeds_entry_category_unread'])
+        self.assertEqual(cursor.fetchone(), (1,))
+
+        # Upgraded databases are left alone
+        call_command('upgrade', stdout=StringIO())
+        self.assertEqual(UniqueEntry.objects.count(), 30)
+
+    @skipUnless(partitions.is_supported(), "Requires PostgreSQL")
+    def test_partitions(self):
+        call_command('partitions', months=1, stdout=StringIO())
+        now = timezone.now()
+        month = partitions.month_start(now)
+        old = partitions.month_start(month - datetime.timedelta(days=400))
+
+        entries = []
+        for date in now, old:
+            content = UniqueEntry.objects.create(
+                title='Title', link='http://example.com/%s' % date.year,
+                date=date,
+            )
+            entries.append(self.user.entries.create(feed=self.feed,
+                                                    content=content,
+                                                    date=date))
+        self.assertEqual(self.user.entries.count(), 2)
+        Entry.objects.filter(pk=entries[0].pk).update(read=True)
+        self.assertTrue(Entry.objects.get(pk=entries[0].pk).read)
+
+        # No partition for the old entry yet, it stays in the parent table
+        cursor = connection.cursor()
+        cursor.execute("SELECT id FROM ONLY feeds_entry")
+        self.assertEqual(cursor.fetchall(), [(entries[1].pk,)])
+
+        call_command('partitions', since=old.strftime('%Y-%m'), move=True,
+                     stdout=StringIO())
+        names = [name for name, start in partitions.get_partitions()]
+        self.assertEqual(names[0], partitions.partition_name(old))
+        self.assertTrue(partitions.partition_name(month) in names)
+        cursor.execute("SELECT COUNT(*) FROM ONLY feeds_entry")
+        self.assertEqual(cursor.fetchone()[0], 0)
+        cursor.execute("SELECT id FROM %s" % partitions.partition_name(old))
+        self.assertEqual(cursor.fetchall(), [(entries[1].pk,)])
+        self.assertEqual(self.user.entries.count(), 2)
+
+        # Partitions are dropped once all their entries have expired
+        call_command('purge', stdout=StringIO())
+        self.assertEqual(len(partitions.get_partitions()), len(names))
+        self.cat.delete_after = '1year'
+        self.cat.save()
+        # Lists don't scan the partitions past the retention period
+        for sql, plan in self.explain(reverse('feeds:category',
+                                              args=['cat'])):
+            self.assertTrue(partitions.partition_name(month) in plan)
+            self.assertFalse(partitions.partition_name(old) in plan)
+        self.user.entries.update(read=True)
+        with patch.object(generations, 'bump') as bump:
+            call_command('purge', stdout=StringIO())
+        # The cached lists of the users who had entries there are dropped
+        bump.assert_any_call(self.user.pk)
+        names = [name for name, start in partitions.get_partitions()]
+        self.assertFalse(partitions.partition_name(old) in names)
+        self.assertTrue(partitions.partition_name(month) in names)
+        self.assertEqual(list(self.user.entries.all()), entries[:1])
+
+    def test_partitions_require_postgresql(self):
+        if not partitions.is_supported():
+            with self.assertRaises(CommandError):
+                call_command('partitions', stdout=StringIO())
+
+    def explain(self, url):
+        """Query plans of the queries on entries made when fetching ``url``"""
+        with capture_queries() as queries:
+            self.client.get(url)
+        queries = [sql for sql in queries if sql.startswith('SELECT') and
+                   'FROM "feeds_entry"' in sql]
+        cursor = connection.cursor()
+        # The tables are tiny: scans and sorts only show up in the plans when
+        # there's no index to avoid them.
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("SET LOCAL enable_sort = off")
+        plans = []
+        for sql in queries:
+            cursor.execute('EXPLAIN ' + sql)
+            plans.append((sql, '\n'.join([row[0]
+                                          for row in cursor.fetchall()])))
+        self.assertTrue(plans)
+        return plans
+
+    @skipUnless(connection.vendor == 'postgresql', "Requires PostgreSQL")
+    @patch('requests.get')
+    def test_query_plans(self, get):
+        """Entry lists are read from an index, in order"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        self.user.entries_per_page = 10
+        self.user.save()
+        Entry.objects.filter(pk__in=list(self.user.entries.values_list(
+            'pk', flat=True)[:10])).update(read=True)
+
+        lists = []
+        for name, args in [('home', []), ('unread', []),
+                           ('category', [self.cat.slug]),
+                           ('unread_category', [self.cat.slug]),
+                           ('feed', [self.feed.pk]),
+                           ('unread_feed', [self.feed.pk])]:
+            url = reverse('feeds:%s' % name, args=args)
+            older = self.client.get(url).context['older_url']
+            lists.extend([url, older])
+        entry = self.user.entries.all()[5]
+        item = reverse('feeds:item', args=[entry.pk])
+
+        for url in lists + [item]:
+            for sql, plan in self.explain(url):
+                self.assertFalse('Seq Scan on feeds_entry' in plan,
+                                 '%s\n%s' % (sql, plan))
+                # Pages are read in index order
+                if url in lists and 'LIMIT' in sql:
+                    self.assertFalse('Sort' in plan, '%s\n%s' % (sql, plan))
+
+        # The partial indexes from the custom SQL
+        cursor = connection.cursor()
+        cursor.execute("SELECT indexname FROM pg_indexes "
+                       "WHERE tablename = 'feeds_entry'")
+        indexes = [name for name, in cursor.fetchall()]
+        self.assertTrue('feeds_entry_user_unread' in indexes)
+        self.assertTrue('feeds_entry_category_unread' in indexes)
+        self.assertTrue('feeds_entry_feed_unread' in indexes)
+
     @patch('requests.get')
     def test_gone(self, get):
         """Muting the feed if the status code is 410"""
@@ -310,8 +627,10 @@ class TestFeeds(TestCase):
 
     def test_entry_model_behaviour(self):
         """Behaviour of the `Entry` model"""
-        entry = Entry(feed=self.feed, title='My title', user=self.user,
-                      date=timezone.now())
+        content = UniqueEntry.objects.create(title='My title',
+                                             date=timezone.now())
+        entry = Entry(feed=self.feed, content=content, user=self.user,
+                      date=content.date)
         entry.save()
 
         # __unicode__
@@ -340,9 +659,549 @@ class TestFeeds(TestCase):
         response = self.client.get(reverse('feeds:home'))
         self.assertContains(response, 'Sign in')  # login required
 
-    def test_paginator(self):
-        response = self.client.get(reverse('feeds:home', args=[5]))
-        self.assertContains(response, 'Home')
+    @patch('requests.get')
+    def test_paginator(self, get):
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        self.user.entries_per_page = 12
+        self.user.save()
+        # Several entries share the same date
+        Entry.objects.filter(pk__in=list(Entry.objects.values_list(
+            'pk', flat=True)[:5])).update(date=timezone.now())
+        expected = list(Entry.objects.order_by('-date', '-pk').values_list(
+            'pk', flat=True))
+
+        url = reverse('feeds:home')
+        pages = []
+        while url is not None:
+            response = self.client.get(url)
+            pages.append([entry.pk for entry in response.context['entries']])
+            url = response.context['older_url']
+        self.assertEqual([len(page) for page in pages], [12, 12, 6])
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual(response.context['total_count'], None)
+
+        # Going back
+        response = self.client.get(response.context['newer_url'])
+        self.assertEqual([entry.pk for entry in response.context['entries']],
+                         pages[1])
+        response = self.client.get(response.context['newer_url'])
+        self.assertEqual([entry.pk for entry in response.context['entries']],
+                         pages[0])
+        self.assertEqual(response.context['newer_url'], None)
+
+        # Deep pages don't depend on the number of entries before them
+        from feedhq.feeds.views import paginate, parse_cursor
+        cursor = response.context['older_url'].split('=')[1]
+        with self.assertNumQueries(1):
+            entries, newer, older = paginate(
+                self.user.entries.all(), before=parse_cursor(cursor),
+                nb_items=12)
+        self.assertEqual([entry.pk for entry in entries], pages[1])
+
+        # Invalid cursors show the first page
+        for cursor in ['foo', '99999999999999999999-1',
+                       '-99999999999999999999-1', '0-99999999999999999999']:
+            self.assertEqual(parse_cursor(cursor), None)
+            response = self.client.get('%s?before=%s' % (
+                reverse('feeds:home'), cursor))
+            self.assertEqual([entry.pk for entry in response.context[
+                'entries']], pages[0])
+            response = self.client.get('%s?q=django&after=%s' % (
+                reverse('feeds:search'), cursor))
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(reverse('feeds:unread') + '?total=1')
+        self.assertEqual(response.context['total_count'], 30)
+
+    @patch('requests.get')
+    def test_timelines(self, get):
+        """Lists page through the timelines in Redis"""
+        from feedhq.feeds.views import paginate
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        self.user.entries_per_page = 12
+        self.user.save()
+        expected = list(self.user.entries.order_by(
+            '-date', '-pk').values_list('pk', flat=True))
+        redis = get_redis_connection()
+        key = timelines.get_key('user', self.user.pk, unread=True)
+
+        def pages(url):
+            pages = []
+            with patch('feedhq.feeds.views.paginate',
+                       wraps=paginate) as sql:
+                while url is not None:
+                    response = self.client.get(url)
+                    pages.append([e.pk for e in response.context['entries']])
+                    url = response.context['older_url']
+            return pages, sql.call_count
+
+        # The last page reaches the end of the timeline and comes from SQL
+        for url in [reverse('feeds:unread'),
+                    reverse('feeds:category', args=[self.cat.slug])]:
+            self.assertEqual(pages(url), ([expected[:12], expected[12:24],
+                                           expected[24:]], 1))
+        self.assertEqual(redis.zcard(key), 31)
+
+        # Read entries leave the unread timelines, and come back
+        entry = Entry.objects.get(pk=expected[0])
+        self.client.get(reverse('feeds:item', args=[entry.pk]))
+        self.assertEqual(redis.zcard(key), 30)
+        self.assertEqual(pages(reverse('feeds:unread'))[0][0],
+                         expected[1:13])
+        self.client.post(reverse('feeds:item', args=[entry.pk]),
+                         {'action': 'unread'})
+        self.assertEqual(redis.zcard(key), 31)
+
+        # New entries are pushed
+        get.return_value = responses(200, 'rss20.xml')
+        self.cat.feeds.create(name='RSS test', url='rss20.xml')
+        pages(reverse('feeds:home'))
+        pages(reverse('feeds:unread'))
+        self.assertEqual(redis.zcard(key), 32)
+        self.cat.feeds.create(name='Copy', url='http://exampleexample.com')
+        new = Entry.objects.get(feed__url='http://exampleexample.com')
+        # Already seen by the user, it's a read entry
+        self.assertTrue(new.read)
+        pages(reverse('feeds:home'))
+        pages(reverse('feeds:unread'))
+        self.assertEqual(redis.zcard(key), 32)
+        self.assertEqual(redis.zscore(timelines.get_key('user', self.user.pk),
+                                      timelines.member(new.pk)),
+                         timelines.score(new.date))
+
+        # Entries pushed while a timeline is rebuilt are kept
+        entry = Entry.objects.get(pk=expected[0])
+        redis.delete(key)
+        timelines.add([entry])
+        timelines.rebuild(key, self.user.entries.unread().exclude(
+            pk=entry.pk))
+        self.assertEqual(redis.zcard(key), 32)
+        self.assertEqual(redis.zscore(key, timelines.member(entry.pk)),
+                         timelines.score(entry.date))
+
+        # Timelines are capped, older pages come from SQL
+        redis.delete(key)
+        with patch.object(timelines, 'SIZE', 20):
+            self.assertEqual(pages(reverse('feeds:unread'))[1], 2)
+            self.assertEqual(redis.zcard(key), 21)
+
+        self.client.post(reverse('feeds:unread'), {'action': 'read'})
+        self.assertFalse(redis.exists(key))
+        self.assertEqual(pages(reverse('feeds:unread'))[0], [[]])
+
+    @patch('requests.get')
+    def test_list_projection(self, get):
+        """Entry lists don't load the content of the entries"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        title = UniqueEntry.objects.all()[0].title
+
+        def get_sql(fetch):
+            with capture_queries() as queries:
+                fetch()
+            sql = ' '.join(queries)
+            self.assertTrue('"feeds_uniqueentry"."title"' in sql or
+                            '"feeds_uniqueentry"."sanitized_title"' in sql)
+            for column in ['subtitle', 'sanitized_content',
+                           'sanitized_nomedia_content', 'excerpt']:
+                self.assertFalse('"feeds_uniqueentry"."%s"' % column in sql)
+
+        for url in [reverse('feeds:home'), reverse('feeds:unread'),
+                    reverse('feeds:feed', args=[self.feed.pk])]:
+            get_sql(lambda: self.assertContains(self.client.get(url), title))
+
+        self.user.is_staff = self.user.is_superuser = True
+        for model in [Entry, UniqueEntry]:
+            request = RequestFactory().get('/')
+            request.user = self.user
+            model_admin = admin.site._registry[model]
+
+            def changelist():
+                # Not rendered, the listed objects are loaded by the view
+                response = model_admin.changelist_view(request)
+                self.assertTrue(title in [
+                    unicode(obj)
+                    for obj in response.context_data['cl'].result_list])
+            get_sql(changelist)
+
+    @patch('requests.get')
+    def test_fragment_cache(self, get):
+        """Fragments are cached until the user's generation is bumped"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+
+        def get_page(url):
+            with capture_queries() as queries:
+                response = self.client.get(url)
+            return response, ' '.join(queries)
+
+        # Categories are only loaded to render the dashboard
+        url = reverse('feeds:dashboard')
+        response, sql = get_page(url)
+        self.assertContains(response, 'Test Feed')
+        self.assertTrue('"feeds_category"' in sql)
+        response, sql = get_page(url)
+        self.assertContains(response, 'Test Feed')
+        self.assertFalse('"feeds_category"' in sql)
+
+        feed = Feed.objects.get(pk=self.feed.pk)
+        feed.name = 'Renamed'
+        feed.save()
+        self.assertContains(get_page(url)[0], 'Renamed')
+
+        # Reading entries
+        url = reverse('feeds:home')
+        self.assertContains(self.client.get(url), 'class="entry new"',
+                            count=30)
+        entry = self.user.entries.all()[0]
+        self.client.get(reverse('feeds:item', args=[entry.pk]))
+        response = self.client.get(url)
+        self.assertContains(response, 'class="entry new"', count=29)
+        self.assertContains(response, 'href="/unread/">29</a>')
+
+        # New entries
+        get.return_value = responses(200, 'rss20.xml')
+        self.cat.feeds.create(name='RSS test', url='rss20.xml')
+        self.assertContains(self.client.get(url), 'class="entry new"',
+                            count=30)
+        generation = generations.get_generation(self.user.pk)
+        Entry.objects.filter(feed__url='rss20.xml').delete()
+        update_feed('rss20.xml', use_etags=False)
+        self.assertTrue(generations.get_generation(self.user.pk) > generation)
+
+    @patch('requests.get')
+    def test_conditional_get(self, get):
+        """Pages are validated with the user's generation"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+
+        home = reverse('feeds:home')
+        for url in [home, reverse('feeds:dashboard'), reverse('export')]:
+            self.client.get(url)
+            etag = self.client.get(url)['ETag']
+            with self.assertNumQueries(2):  # Session and user
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+        # Reading entries changes the validator
+        etag = self.client.get(home)['ETag']
+        entry = self.user.entries.all()[0]
+        self.client.get(reverse('feeds:item', args=[entry.pk]))
+        response = self.client.get(home, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # Messages aren't missed
+        response = self.client.post(home, {'action': 'read'}, follow=True)
+        self.assertEqual(len(response.context['messages']), 1)
+        self.assertFalse(response.has_header('ETag'))
+
+    @patch('requests.get')
+    def test_list_fragment(self, get):
+        """AJAX requests get the entry list or the counts alone"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        ajax = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+
+        url = reverse('feeds:unread')
+        page = self.client.get(url)
+        self.client.get(url, **ajax)
+        # Session, user and the entries of the page, and the categories on
+        # PostgreSQL
+        with self.assertNumQueries(4 if partitions.is_supported() else 3):
+            response = self.client.get(url, **ajax)
+        self.assertTemplateUsed(response, 'feeds/entry_list.html')
+        self.assertTemplateNotUsed(response, 'base.html')
+        self.assertContains(response, 'data-url="%s"' % url)
+        self.assertContains(response, '<li class="entry', 30)
+        self.assertTrue(response['Vary'].startswith('X-Requested-With'))
+        self.assertNotEqual(response['ETag'], page['ETag'])
+
+        response = self.client.get(reverse('feeds:unread_counts'))
+        self.assertEqual(json.loads(response.content), {
+            'total': 30,
+            'categories': {str(self.cat.pk): 30},
+            'feeds': {str(self.feed.pk): 30},
+        })
+
+        # Marking as read gets the fragment of the list, without a message
+        response = self.client.post(url, {'action': 'read'}, follow=True,
+                                    **ajax)
+        self.assertTemplateUsed(response, 'feeds/entry_list.html')
+        self.assertContains(response,
+                            'data-url="%s"' % reverse('feeds:home'))
+        response = self.client.get(reverse('feeds:home'))
+        self.assertEqual(len(response.context['messages']), 0)
+        response = self.client.get(reverse('feeds:unread_counts'))
+        self.assertEqual(json.loads(response.content)['total'], 0)
+
+    @patch('requests.get')
+    def test_navigation(self, get):
+        """Previous / next links come from the cached list page"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        self.user.entries_per_page = 12
+        self.user.save()
+        ids = list(self.user.entries.values_list('pk', flat=True))
+
+        def navigation(pk):
+            response = self.client.get(item_url(pk))
+            links = []
+            for name in 'previous', 'next':
+                link = response.context[name]
+                if link is not None:
+                    # The list is carried over
+                    self.assertEqual(link, item_url(int(link.split('/')[-2])))
+                links.append(link and int(link.split('/')[-2]))
+            return links
+
+        def count_queries(pk):
+            with capture_queries() as queries:
+                self.client.get(item_url(pk))
+            return len(queries)
+
+        def item_url(pk):
+            return '%s?back=%s' % (reverse('feeds:item', args=[pk]),
+                                   urlquote(back, safe=''))
+
+        back = reverse('feeds:unread')
+        self.client.get(back)
+        self.assertEqual(navigation(ids[0]), [None, ids[1]])
+        self.assertEqual(navigation(ids[5]), [ids[4], ids[6]])
+        # Read entries stay in the unread list being browsed
+        self.assertEqual(navigation(ids[6]), [ids[5], ids[7]])
+        # On the next page
+        self.assertEqual(navigation(ids[11]), [ids[10], ids[12]])
+
+        # Cache hits save the queries
+        hit = count_queries(ids[5])
+        cache.delete('navigation:%s' % self.user.pk)
+        self.assertEqual(count_queries(ids[5]) - hit, 2)
+        # Without the cache, unread lists skip the entries that were read
+        self.assertEqual(navigation(ids[7]), [ids[4], ids[8]])
+
+        url = reverse('feeds:category', args=['cat'])
+        response = self.client.get(url)
+        back = response.context['older_url']
+        response = self.client.get(back)
+        self.assertEqual(response.context['entries'][0].pk, ids[12])
+        self.assertEqual(navigation(ids[12]), [ids[11], ids[13]])
+        self.assertEqual(navigation(ids[29]), [ids[28], None])
+
+    @patch('requests.get')
+    def test_entry_rows(self, get):
+        """List rows are prepared by the view, unless the list is cached"""
+        from feedhq.feeds.views import get_rows
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        self.user.timezone = 'Pacific/Auckland'
+        self.user.save()
+        Feed.objects.filter(pk=self.feed.pk).update(
+            favicon='favicons/feed.png')
+
+        url = reverse('feeds:unread_category', args=[self.cat.slug])
+        with patch('feedhq.feeds.views.get_rows', wraps=get_rows) as rows:
+            response = self.client.get(url)
+            self.client.get(url)
+        self.assertEqual(rows.call_count, 1)
+
+        entry = response.context['entries'][0]
+        self.assertContains(response, "url('/media/favicons/feed.png')",
+                            count=30)
+        self.assertContains(response, 'href="%s" class="cat %s"' % (
+            reverse('feeds:unread_feed', args=[self.feed.pk]),
+            self.cat.color), count=30)
+        date = Template('{{ date|timezone:"Pacific/Auckland"|date }}')
+        self.assertContains(response, '<div class="date">%s</div>' % (
+            date.render(Context({'date': entry.date}))))
+
+    @patch('requests.get')
+    def test_back_url(self, get):
+        """Entries go back to the list passed in their URL"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        entry = self.user.entries.all()[0]
+        url = reverse('feeds:item', args=[entry.pk])
+
+        back = reverse('feeds:unread_category', args=[self.cat.slug])
+        response = self.client.post('%s?back=%s' % (url, back),
+                                    {'action': 'unread'})
+        self.assertRedirects(response, back)
+
+        # Only entry lists are accepted
+        for back in ['http://example.com/', '//example.com/',
+                     reverse('profile'), '/no/such/page/']:
+            response = self.client.post('%s?back=%s' % (url, back),
+                                        {'action': 'unread'})
+            self.assertRedirects(response, self.feed.get_absolute_url())
+        self.assertFalse('back_url' in self.client.session)
+
+    @patch('requests.get')
+    def test_search(self, get):
+        """Entries are searched by the words of their title and content"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        url = reverse('feeds:search')
+
+        response = self.client.get(url)
+        self.assertEqual(response.context['query'], None)
+
+        response = self.client.get(url, {'q': 'MongoDB'})
+        titles = [entry.content.title for entry in response.context['entries']]
+        self.assertTrue('Geospatial Indexing in MongoDB' in titles)
+        self.assertTrue('Notes from a production MongoDB deployment' in titles)
+        for entry in response.context['entries']:
+            self.assertTrue('mongodb' in u' '.join([
+                entry.content.title, entry.content.subtitle]).lower())
+
+        response = self.client.get(url, {'q': 'mongodb nosuchword'})
+        self.assertEqual(len(response.context['entries']), 0)
+        self.assertContains(response, 'No entries match your search.')
+
+        # Other users' entries aren't found
+        user = User.objects.create_user('other', 'other@example.com', 'pass')
+        category = user.categories.create(name='Cat', slug='cat')
+        category.feeds.create(name='Same Feed', url=self.feed.url)
+        response = self.client.get(url, {'q': 'MongoDB'})
+        self.assertEqual(len(titles), len(response.context['entries']))
+
+        # Results are paginated, newest first
+        self.user.entries_per_page = 5
+        self.user.save()
+        matching = list(search.search(self.user.entries.all(),
+                                      'django').values_list('pk', flat=True))
+        self.assertTrue(len(matching) > 5)
+        found = []
+        page = '%s?q=django' % url
+        while page is not None:
+            response = self.client.get(page)
+            found.extend([entry.pk for entry in response.context['entries']])
+            page = response.context['older_url']
+        self.assertEqual(found, matching)
+
+        # Search results are a list entries are read from
+        link = lxml.html.fromstring(response.content).xpath(
+            '//ul[@id="entries"]//a[not(@class)]')[0].get('href')
+        back = urlparse.parse_qs(urlparse.urlparse(link).query)['back'][0]
+        self.assertTrue(back.startswith('%s?q=django&before=' % url))
+        response = self.client.get(link)
+        self.assertEqual(response.context['back_url'], back)
+        self.assertEqual(response.context['previous'], None)
+        self.assertEqual(response.context['next'], None)
+
+        # The sanitize command indexes the contents again
+        if connection.vendor == 'postgresql':
+            connection.cursor().execute(
+                "UPDATE feeds_uniqueentry SET search_vector = NULL")
+        else:
+            SearchTerm.objects.all().delete()
+        self.assertFalse(search.search(self.user.entries.all(),
+                                       'django').exists())
+        call_command('sanitize', all=True, stdout=StringIO())
+        self.assertEqual(list(search.search(
+            self.user.entries.all(), 'django',
+        ).values_list('pk', flat=True)), matching)
+
+    @patch('requests.get')
+    def test_sync_api(self, get):
+        """Clients get the entries that changed since their last sync"""
+        url = reverse('feeds:api_sync')
+
+        def fetch(url, **params):
+            response = self.client.get(url, params)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            return json.loads(''.join(response.streaming_content))
+
+        data = fetch(url)
+        self.assertEqual(data['entries'], [])
+        self.assertEqual(data['next'], None)
+        first_token = data['token']
+
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        ids = sorted(self.user.entries.values_list('pk', flat=True))
+
+        # A full sync is paginated by id
+        with patch('feedhq.feeds.api.PAGE_SIZE', 20):
+            data = fetch(url)
+            self.assertTrue(data['reset'])
+            token = data['token']
+            found = [entry['id'] for entry in data['entries']]
+            while data['next'] is not None:
+                data = fetch(data['next'])
+                self.assertFalse(data['reset'])
+                self.assertEqual(data['token'], token)
+                found.extend([entry['id'] for entry in data['entries']])
+        self.assertEqual(found, ids)
+        self.assertEqual(data['unread']['total'], 30)
+
+        # New entries
+        data = fetch(url, since=first_token)
+        self.assertFalse(data['reset'])
+        self.assertEqual(len(data['entries']), 30)
+        self.assertEqual(data['token'], token)
+        data = fetch(url, since=token)
+        self.assertEqual(data['entries'], [])
+        self.assertEqual(data['token'], token)
+
+        # Read state changes
+        self.client.get(reverse('feeds:item', args=[ids[0]]))
+        data = fetch(url, since=token)
+        self.assertEqual([(entry['id'], entry['read'])
+                          for entry in data['entries']], [(ids[0], True)])
+        self.assertEqual(data['unread']['total'], 29)
+        self.assertEqual(data['read_through'], [])
+        token = data['token']
+
+        # Marking everything as read is a watermark
+        self.client.post(reverse('feeds:home'), {'action': 'read'})
+        data = fetch(url, since=token)
+        self.assertEqual(data['entries'], [])
+        self.assertEqual(data['read_through'], [{
+            'category': self.cat.pk, 'read_through': ids[-1],
+        }])
+        self.assertEqual(data['unread']['total'], 0)
+
+        # Changes the log doesn't have anymore
+        data = fetch(url, since=1)
+        self.assertTrue(data['reset'])
+        self.assertEqual(len(data['entries']), 30)
+        response = self.client.get(url, {'since': 'foo'})
+        self.assertEqual(response.status_code, 400)
+
+        # Bodies, by id
+        url = reverse('feeds:api_entries')
+        data = fetch(url, ids='%s,%s,0' % (ids[1], ids[0]))
+        self.assertEqual([entry['id'] for entry in data['entries']],
+                         [ids[1], ids[0]])
+        self.assertEqual(data['entries'][1]['content'], Entry.objects.get(
+            pk=ids[0]).content.sanitized_content)
+        self.assertEqual(data['missing'], [0])
+        response = self.client.get(url, {'ids': ','.join(map(str, ids * 4))})
+        self.assertEqual(response.status_code, 400)
+
+        # Deleted entries, by the purge or with their feed
+        url = reverse('feeds:api_sync')
+        token = fetch(url, since=token)['token']
+        purged = list(self.user.entries.order_by('-date', '-pk').values_list(
+            'pk', flat=True))[28:]
+        self.feed.keep_last = 28
+        self.feed.save()
+        call_command('purge', stdout=StringIO())
+        data = fetch(url, since=token)
+        self.assertEqual(data['entries'], [])
+        self.assertEqual(sorted(data['deleted']), sorted(purged))
+        token = data['token']
+        self.feed.delete()
+        data = fetch(url, since=token)
+        self.assertEqual(data['entries'], [])
+        self.assertEqual(sorted(data['deleted']),
+                         sorted(set(ids) - set(purged)))
+
+        self.client.logout()
+        response = self.client.get(url, {'ids': ids[0]})
+        self.assertEqual(response.status_code, 403)
 
     def test_category(self):
         url = reverse('feeds:category', args=['cat'])
@@ -359,7 +1218,7 @@ class TestFeeds(TestCase):
 
     def test_only_unread(self):
         url = reverse('feeds:unread_category', args=['cat'])
-        response = self.client.get(url)
+        response = self.client.get(url + '?total=1')
 
         self.assertContains(response, 'Cat')
         self.assertContains(response, 'all <span class="ct">')
@@ -481,18 +1340,30 @@ class TestFeeds(TestCase):
     def test_invalid_page(self):
         # We need more than 25 entries
         update_feed(self.feed.url)
-        url = reverse('feeds:home', args=[12000])  # that page doesn't exist
-        response = self.client.get(url)
-        self.assertContains(response, '<a href="/" class="current">')
+        for cursor in ['12000', '0-0']:
+            url = reverse('feeds:home') + '?before=' + cursor
+            response = self.client.get(url)
+            self.assertContains(response, '<a href="/" class="current">')
 
     # This is called by other tests
     def _test_entry(self, from_url):
-        self.assertEqual(self.client.get(from_url).status_code, 200)
+        response = self.client.get(from_url)
+        self.assertEqual(response.status_code, 200)
+
+        # Entries link back to the list
+        first = response.context['entries'][0]
+        self.assertContains(response, 'href="%s?back=%s"' % (
+            reverse('feeds:item', args=[first.pk]),
+            urlquote(from_url, safe='')))
 
-        e = Entry.objects.get(title="jacobian's django-deployment-workshop")
-        url = reverse('feeds:item', args=[e.pk])
+        e = Entry.objects.get(
+            content__title="jacobian's django-deployment-workshop",
+        )
+        url = '%s?back=%s' % (reverse('feeds:item', args=[e.pk]),
+                              urlquote(from_url, safe=''))
         response = self.client.get(url)
         self.assertContains(response, "jacobian's django-deployment-workshop")
+        self.assertContains(response, 'action="%s"' % url)
 
     @patch('requests.get')
     def test_entry(self, get):
@@ -528,12 +1399,16 @@ class TestFeeds(TestCase):
         self.assertNotContains(response, 'Next →')
 
     def test_img(self):
-        entry = Entry.objects.create(
-            feed=self.feed,
+        content = UniqueEntry.objects.create(
             title="Random title",
             subtitle='<img src="/favicon.png">',
             permalink='http://example.com',
             date=timezone.now(),
+        )
+        entry = Entry.objects.create(
+            feed=self.feed,
+            content=content,
+            date=content.date,
             user=self.user,
         )
         url = reverse('feeds:item', args=[entry.pk])
@@ -627,6 +1502,93 @@ class TestFeeds(TestCase):
             '<a class="unread" title="Unread entries" href="/unread/">30</a>'
         )
 
+    @patch('requests.get')
+    def test_unread_counters(self, get):
+        """Counters are maintained incrementally and repaired in bulk"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+
+        def unread_count():
+            return Feed.objects.get(pk=self.feed.pk).unread_count
+        self.assertEqual(unread_count(), 30)
+
+        entry = self.user.entries.all()[0]
+        url = reverse('feeds:item', args=[entry.pk])
+        with self.assertNumQueries(0):
+            self.feed.incr_unread_count(0)
+        self.client.get(url)
+        self.assertEqual(unread_count(), 29)
+        self.client.get(url)
+        self.assertEqual(unread_count(), 29)
+        self.client.post(url, {'action': 'unread'})
+        self.assertEqual(unread_count(), 30)
+
+        self.feed.incr_unread_count(-40)
+        self.assertEqual(unread_count(), 0)
+
+        call_command('fixcounts', stdout=StringIO())
+        self.assertEqual(unread_count(), 30)
+
+    @patch('requests.get')
+    def test_move_feed(self, get):
+        """Entries follow their feed to another category"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        self.assertEqual(self.cat.entries.count(), 30)
+
+        other = self.user.categories.create(name='Other', slug='other',
+                                            delete_after='never')
+        url = reverse('feeds:edit_feed', args=[self.feed.pk])
+        response = self.client.post(url, {'name': self.feed.name,
+                                          'url': self.feed.url,
+                                          'category': other.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.cat.entries.count(), 0)
+        self.assertEqual(other.entries.count(), 30)
+
+        response = self.client.get(reverse('feeds:category', args=['other']))
+        self.assertEqual(len(response.context['entries']), 30)
+
+    @patch('requests.get')
+    def test_redis_unread_counts(self, get):
+        """Unread counts are cached in Redis and kept up to date"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+
+        def assertCounts(total, feed, category):
+            with self.assertNumQueries(0):
+                counts = counters.get_counts(self.user.pk)
+            self.assertEqual(counts.total, total)
+            self.assertEqual(counts.feed(self.feed.pk), feed)
+            self.assertEqual(counts.category(self.cat.pk), category)
+
+        # Built from the database on the first read
+        with self.assertNumQueries(1):
+            counters.get_counts(self.user.pk)
+        assertCounts(30, 30, 30)
+
+        entry = self.user.entries.all()[0]
+        self.client.get(reverse('feeds:item', args=[entry.pk]))
+        assertCounts(29, 29, 29)
+
+        # Moving the feed to another category
+        other = self.user.categories.create(name='Other', slug='other')
+        feed = Feed.objects.get(pk=self.feed.pk)
+        feed.category = other
+        feed.save()
+        counts = counters.get_counts(self.user.pk)
+        self.assertEqual(counts.category(self.cat.pk), 0)
+        self.assertEqual(counts.category(other.pk), 29)
+
+        self.client.post(reverse('feeds:unread'), {'action': 'read'})
+        counts = counters.get_counts(self.user.pk)
+        self.assertEqual(counts.total, 0)
+
+        self.assertContains(self.client.get(reverse('feeds:home')),
+                            'href="/unread/">0</a>')
+        other.delete()
+        self.assertEqual(counters.get_counts(self.user.pk).feeds, {})
+
     @patch('requests.get')
     def test_mark_as_read(self, get):
         url = reverse('feeds:unread')
@@ -644,6 +1606,84 @@ class TestFeeds(TestCase):
         self.assertEqual(len(response.redirect_chain), 1)
         self.assertContains(response, '30 entries have been marked as read')
 
+    @patch('requests.get')
+    def test_read_through(self, get):
+        """Marking everything as read moves a watermark"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        entries = list(self.user.entries.all())
+        # Entries of other lists are left alone
+        user = User.objects.create_user('other', 'other@example.com', 'pass')
+        category = user.categories.create(name='Cat', slug='cat',
+                                          delete_after='never')
+        other = category.feeds.create(name='Other', url='other.xml')
+        self.assertTrue(other.entries.exists())
+
+        url = reverse('feeds:unread_category', args=['cat'])
+        with patch('feedhq.feeds.views.enqueue') as enqueue:
+            self.client.post(url, {'action': 'read'})
+        self.assertEqual(enqueue.call_count, 1)
+        self.assertEqual(Category.objects.get(pk=self.cat.pk).read_through,
+                         max([entry.pk for entry in entries]))
+        self.assertEqual(self.user.entries.filter(read=False).count(), 30)
+        self.assertEqual(self.user.entries.unread().count(), 0)
+        self.assertEqual(len(self.client.get(url).context['entries']), 0)
+        response = self.client.get(reverse('feeds:home'))
+        self.assertNotContains(response, 'entry new')
+
+        # Entries added later are unread
+        content = UniqueEntry.objects.create(title='New', link='http://new',
+                                             date=timezone.now())
+        new = self.user.entries.create(feed=self.feed, content=content,
+                                       date=content.date)
+        self.assertEqual(list(self.user.entries.unread()), [new])
+        new.delete()
+
+        self.client.get(reverse('feeds:item', args=[entries[0].pk]))
+        self.assertEqual(Feed.objects.get(pk=self.feed.pk).unread_count, 0)
+
+        # Marking an entry as unread flags the entries below the watermarks
+        # covering it
+        empty = self.user.categories.create(name='Empty', slug='empty')
+        Category.objects.filter(pk=empty.pk).update(read_through=1)
+        self.client.post(reverse('feeds:item', args=[entries[1].pk]),
+                         {'action': 'unread'})
+        self.assertEqual(list(self.user.entries.unread()), [entries[1]])
+        self.assertEqual(Category.objects.get(pk=self.cat.pk).read_through, 0)
+        self.assertEqual(Category.objects.get(pk=empty.pk).read_through, 1)
+        self.assertEqual(Feed.objects.get(pk=self.feed.pk).unread_count, 1)
+
+        # Reading and unreading in the same request
+        with patch('feedhq.feeds.views.compact_watermark') as compact:
+            self.client.post(reverse('feeds:item', args=[entries[1].pk]),
+                             {'action': 'unread'})
+        self.assertFalse(compact.called)
+        self.assertEqual(list(self.user.entries.unread()), [entries[1]])
+        empty.delete()
+
+        # Compaction
+        with patch('feedhq.feeds.views.enqueue'):
+            self.client.post(reverse('feeds:unread'), {'action': 'read'})
+        self.assertNotEqual(Category.objects.get(
+            pk=self.cat.pk).read_through, 0)
+        with self.assertNumQueries(6):
+            compact_read_state(self.user.pk)
+        self.assertEqual(self.user.entries.filter(read=False).count(), 0)
+        self.assertEqual(Category.objects.get(pk=self.cat.pk).read_through, 0)
+
+        # Moving a feed keeps the read state of its entries
+        ids = sorted([entry.pk for entry in entries])
+        self.user.entries.update(read=False)
+        Category.objects.filter(pk=self.cat.pk).update(read_through=ids[-2])
+        moved = self.user.categories.create(name='Moved', slug='moved')
+        Category.objects.filter(pk=moved.pk).update(read_through=ids[-1])
+        feed = Feed.objects.get(pk=self.feed.pk)
+        feed.category = moved
+        feed.save()
+        self.assertEqual([entry.pk for entry in self.user.entries.unread()],
+                         [ids[-1]])
+        self.assertEqual(self.user.entries.filter(read=False).count(), 1)
+
     @patch('requests.get')
     @patch('oauth2.Client')
     def test_add_to_readability(self, Client, get):
@@ -681,6 +1721,12 @@ class TestFeeds(TestCase):
                                           method='GET')
         self.assertEqual(Entry.objects.get(pk=entry_pk).read_later_url,
                          'https://www.readability.com/articles/foo')
+
+        # The read state isn't overwritten
+        entry = Entry.objects.get(pk=entry_pk)
+        Entry.objects.filter(pk=entry_pk).update(read=False)
+        entry.add_to_readability()
+        self.assertFalse(Entry.objects.get(pk=entry_pk).read)
         response = self.client.get(url)
         self.assertNotContains(response, "Add to Instapaper")
 
@@ -780,7 +1826,7 @@ class TestFeeds(TestCase):
 
         # Check content handling
         for entry in feed.entries.all():
-            self.assertTrue(len(entry.subtitle) > 2400)
+            self.assertTrue(len(entry.content.subtitle) > 2400)
 
         # Check date handling
         self.assertEqual(feed.entries.filter(date__year=2011).count(), 3)
@@ -856,9 +1902,241 @@ class TestFeeds(TestCase):
 
         self.assertEqual(Entry.objects.count(), 2)
         # One entry is unread
-        Entry.objects.get(link="http://example.org/item/1", read=False)
+        Entry.objects.get(content__link="http://example.org/item/1",
+                          read=False)
         # Other is read
-        Entry.objects.get(link="http://example.org/item/1", read=True)
+        Entry.objects.get(content__link="http://example.org/item/1",
+                          read=True)
+
+    @patch('requests.get')
+    def test_duplicate_old_link(self, get):
+        """Links are matched against all the entries of the user"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+        oldest = self.user.entries.order_by('date')[0]
+
+        with patch.object(duplicates, 'INDEX_SIZE', 1):
+            duplicates.invalidate(self.user.pk)
+            index = duplicates.DuplicateIndex.load(
+                self.user.pk, [oldest.content.link, u'http://example.com/'])
+        self.assertEqual(index.links, set([oldest.content.link]))
+        self.assertTrue(index.contains(UniqueEntry(link=oldest.content.link)))
+        self.assertEqual(len(get_redis_connection().lrange(
+            duplicates.INDEX_KEY % self.user.pk, 0, -1)), 1)
+
+    @patch('requests.get')
+    def test_near_duplicate(self, get):
+        """Syndicated copies with rewritten links are marked as read"""
+        get.return_value = responses(200, self.feed.url)
+        update_feed(self.feed.url, use_etags=False)
+
+        with open(test_file('sw-all.xml'), 'r') as f:
+            data = f.read().replace('simonwillison.net', 'planet.example.com')
+        response = responses(200)
+        response.raw = StringIO(data)
+        get.return_value = response
+        self.cat.feeds.create(url='http://planet.example.com/feed/')
+
+        self.assertEqual(self.user.entries.count(), 60)
+        copies = self.user.entries.filter(
+            content__link__contains='planet.example.com')
+        self.assertEqual(copies.filter(read=True).count(), 26)
+        # Entries too short to be fingerprinted are only matched by link
+        self.assertEqual(
+            copies.filter(read=False, content__fingerprint=None).count(), 4)
+
+
+class DuplicatesTests(TestCase):
+    text = (u'SimHash fingerprints are computed on shingles of the title '
+            u'and text of entries, so that small changes only flip a few '
+            u'bits of the fingerprint. Syndicated copies of an article are '
+            u'detected even if aggregators rewrote their links or added a '
+            u'short footer.')
+
+    def test_fingerprint(self):
+        value = duplicates.fingerprint(self.text)
+        self.assertTrue(-2 ** 63 <= value < 2 ** 63)
+        self.assertEqual(duplicates.fingerprint(self.text.upper()), value)
+
+        copy = duplicates.fingerprint(self.text + u' Via')
+        self.assertTrue(duplicates.distance(value, copy) <=
+                        duplicates.DISTANCE)
+
+        other = duplicates.fingerprint(u' '.join(reversed(self.text.split())))
+        self.assertTrue(duplicates.distance(value, other) >
+                        duplicates.DISTANCE)
+
+        self.assertEqual(duplicates.fingerprint(u'Too short'), None)
+
+    def test_index(self):
+        value = duplicates.fingerprint(self.text)
+        index = duplicates.DuplicateIndex(1, [value], [u'http://a.com/'])
+        self.assertTrue(index.contains(
+            UniqueEntry(link=u'http://a.com/', fingerprint=None)))
+        self.assertTrue(index.contains(
+            UniqueEntry(link=u'http://b.com/', fingerprint=value ^ 0b101)))
+        self.assertFalse(index.contains(
+            UniqueEntry(link=u'http://b.com/', fingerprint=~value)))
+        self.assertFalse(index.contains(
+            UniqueEntry(link=u'http://b.com/', fingerprint=None)))
+
+        # Concurrent updates keep each other's fingerprints
+        duplicates.invalidate(1)
+        first = duplicates.DuplicateIndex.load(1)
+        second = duplicates.DuplicateIndex.load(1)
+        first.add(UniqueEntry(link=u'http://a.com/', fingerprint=value))
+        second.add(UniqueEntry(link=u'http://b.com/', fingerprint=~value))
+        first.save()
+        second.save()
+        index = duplicates.DuplicateIndex.load(1)
+        self.assertTrue(index.contains(UniqueEntry(fingerprint=value)))
+        self.assertTrue(index.contains(UniqueEntry(fingerprint=~value)))
+        # Links are looked up in the database
+        self.assertFalse(index.contains(UniqueEntry(link=u'http://a.com/')))
+
+
+class PipelineTests(TestCase):
+    def test_tracking_pixels(self):
+        document = pipeline.process(
+            u'<p>Text<img src="/a.png" width="1" height="1">'
+            u'<img src="/b.png" width="0px"><img src="/c.png" width="10"></p>'
+        )
+        self.assertEqual(document.inner_html,
+                         u'<p>Text<img src="/c.png" width="10"/></p>')
+        self.assertTrue(document.has_media)
+        self.assertEqual(document.sanitized_nomedia_content,
+                         u'<div><p>Text</p></div>')
+
+        # Both versions come from a single sanitizer pass, without bleach
+        sanitizer = sanitizers.get_sanitizer()
+        self.assertTrue(isinstance(sanitizer, LxmlSanitizer))
+        with patch.object(sanitizer, 'sanitize_tree',
+                          wraps=sanitizer.sanitize_tree) as sanitize:
+            with patch('bleach.clean') as clean:
+                document = pipeline.process(u'<p>Text<img src="/c.png"></p>')
+        self.assertEqual(sanitize.call_count, 1)
+        self.assertFalse(clean.called)
+        self.assertEqual(document.sanitized_content,
+                         u'<div><p>Text<img src="/c.png"></p></div>')
+        self.assertEqual(document.sanitized_nomedia_content,
+                         u'<div><p>Text</p></div>')
+
+        document = pipeline.process(u'<p>Text<img src="/a.png" width="1">')
+        self.assertFalse(document.has_media)
+        self.assertEqual(document.sanitized_content,
+                         document.sanitized_nomedia_content)
+
+    def test_excerpt(self):
+        document = pipeline.process(u'<p>Some   <b>bold</b>\n text</p>')
+        self.assertEqual(document.excerpt, u'Some bold text')
+
+        document = pipeline.process(u'<p>%s</p>' % (u'word ' * 100))
+        self.assertTrue(len(document.excerpt) <= pipeline.EXCERPT_LENGTH)
+        self.assertTrue(document.excerpt.endswith(u'word…'))
+
+    def test_custom_stages(self):
+        stages = [pipeline.extract_excerpt]
+        document = pipeline.process(u'<img src="/a.png"> Text', stages)
+        self.assertEqual(document.excerpt, u'Text')
+        self.assertFalse(document.has_media)
+        self.assertEqual(document.sanitized_content, u'')
+
+    def test_reprocessing(self):
+        """Processing stored content again gives the same result"""
+        document = pipeline.process(u'<p>Text</p>')
+        again = pipeline.process(document.inner_html)
+        self.assertEqual(document.html, again.html)
+        self.assertEqual(document.sanitized_content, again.sanitized_content)
+
+
+def normalize_html(html):
+    """Serializes ``html`` with sorted attributes. Leading newlines in <pre>
+    are dropped, HTML parsers ignore them anyway."""
+    tree = lxml.html.fragment_fromstring(html, create_parent='div')
+    for element in tree.iter():
+        if not isinstance(element.tag, basestring):
+            continue
+        attributes = sorted(element.attrib.items())
+        element.attrib.clear()
+        for name, value in attributes:
+            element.set(name, value)
+        if element.tag == 'pre' and element.text:
+            element.text = element.text.lstrip('\n')
+    return lxml.html.tostring(tree, encoding=unicode)
+
+
+class SanitizerTests(TestCase):
+    def setUp(self):
+        super(SanitizerTests, self).setUp()
+        whitelists = (UniqueEntry.ELEMENTS, UniqueEntry.ATTRIBUTES,
+                      UniqueEntry.CSS_PROPERTIES)
+        self.backends = [BleachSanitizer(*whitelists),
+                         LxmlSanitizer(*whitelists)]
+
+    def assertSameOutput(self, tree):
+        for media in (True, False):
+            bleached, cleaned = [
+                normalize_html(backend.clean_tree(tree, media=media))
+                for backend in self.backends
+            ]
+            self.assertEqual(bleached, cleaned)
+
+    def test_hostile_content(self):
+        content = (
+            u'<p onclick="evil()" style="color: red; position: fixed; '
+            u'background: url(http://evil.com/)">Text<!-- comment -->'
+            u'<script>alert(1)</script><iframe src="http://evil.com/">'
+            u'</iframe><a href="javascript:alert(1)" title="t">link</a>'
+            u'<a href=" JaVaScRiPt:alert(1)">other</a>'
+            u'<a href="http://example.com/?a=1&amp;b=2">ok</a>'
+            u'<img src="data:image/png;base64,xxx"><img src="/a.png" '
+            u'alt="&lt;&quot;"></p><form action="/"><input name="q"></form>'
+        )
+        tree = pipeline.Document(content).tree
+        self.assertSameOutput(tree)
+
+        html = self.backends[1].clean_tree(tree)
+        self.assertFalse('onclick' in html)
+        self.assertFalse('<script' in html)
+        self.assertFalse('<iframe' in html)
+        self.assertFalse('comment' in html)
+        self.assertFalse('javascript' in html.lower())
+        self.assertFalse('style' in html)
+        self.assertTrue('alert(1)' in html)
+        self.assertTrue('a=1&amp;b=2' in html)
+
+    def test_styles(self):
+        tree = pipeline.Document(
+            u'<p style="color: red; position: fixed; '
+            u'background: url(http://evil.com/)">Text</p>'
+            u'<p style="color: expression(evil())">Text</p>'
+        ).tree
+        attributes = UniqueEntry.ATTRIBUTES | set(['style'])
+        results = [
+            backend.__class__(backend.tags, attributes,
+                              backend.styles).clean_tree(tree)
+            for backend in self.backends
+        ]
+        self.assertEqual(results[1], u'<div><p style="color: red;">Text</p>'
+                                     u'<p style="">Text</p></div>')
+        self.assertEqual(*[normalize_html(html) for html in results])
+
+    def test_media(self):
+        tree = pipeline.Document(u'<p>Text<img src="/a.png"></p>').tree
+        for backend in self.backends:
+            self.assertEqual(backend.clean_tree(tree, media=False),
+                             u'<div><p>Text</p></div>')
+            self.assertEqual(backend.clean(u'<video src="/a.mp4">'),
+                             u'<div><video src="/a.mp4"></video></div>')
+
+    def test_fixtures(self):
+        """Both backends produce the same markup on real-world content"""
+        for name in sorted(os.listdir(TEST_DATA)):
+            if not name.endswith(('.xml', '.atom')):
+                continue
+            for entry in feedparser.parse(test_file(name)).entries:
+                content = FeedUpdater.get_content(entry)
+                self.assertSameOutput(pipeline.Document(content).tree)
 
 
 class FaviconTests(TestCase):